@@ -0,0 +1,216 @@
+# -*- coding: utf8 -*-
+
+# Copyright (C) 2016  Ben Ockmore
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+""" This module provides an optional in-process prefix index of the default
+alias names of entities, which is used to answer autocomplete searches without
+a round trip to Elasticsearch.
+"""
+
+
+import bisect
+import threading
+import time
+import unicodedata
+from datetime import timedelta
+
+from bbschema import Entity
+from sqlalchemy.orm import joinedload
+
+from .services import db
+
+
+def normalize_name(name):
+    """ Normalizes a name for prefix matching, by lower-casing it, removing
+    accents and collapsing whitespace.
+    """
+    decomposed = unicodedata.normalize('NFKD', name.lower())
+    stripped = u''.join(c for c in decomposed if not unicodedata.combining(c))
+    return u' '.join(stripped.split())
+
+
+class SortedNames(object):
+    """ A sorted array of normalized names, with a parallel array of
+    (entity_gid, type, name) entries.
+    """
+
+    def __init__(self, items=()):
+        self.keys = [key for key, _ in items]
+        self.entries = [entry for _, entry in items]
+
+    def insert(self, key, entry):
+        index = bisect.bisect_right(self.keys, key)
+        self.keys.insert(index, key)
+        self.entries.insert(index, entry)
+
+    def remove(self, key, entity_gid):
+        index = bisect.bisect_left(self.keys, key)
+        while index < len(self.keys) and self.keys[index] == key:
+            if self.entries[index][0] == entity_gid:
+                del self.keys[index]
+                del self.entries[index]
+                return
+            index += 1
+
+    def prefix_range(self, prefix):
+        return (bisect.bisect_left(self.keys, prefix),
+                bisect.bisect_left(self.keys, prefix + u'\uffff'))
+
+
+class AutocompleteIndex(object):
+    """ Sorted arrays of normalized default alias names, one for all entities
+    and one for each entity type, so prefix searches are answered with a
+    binary search whether or not they are limited to a collection. The index
+    is built from the database, and refreshed incrementally with the entities
+    updated since the last refresh.
+    """
+
+    def __init__(self):
+        self.names = {None: SortedNames()}
+        self.entity_entries = {}
+        self.last_updated = None
+        self.refreshed_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.refreshed_at is not None
+
+    def build(self):
+        """ Builds the index from the master revisions of all entities. """
+        entities = db.session.query(Entity).options(
+            joinedload('master_revision.entity_data.default_alias')
+        ).all()
+
+        items = {None: []}
+        entity_entries = {}
+        for entity in entities:
+            entry = self.make_entry(entity)
+            if entry is not None:
+                item = (normalize_name(entry[2]), entry)
+                items[None].append(item)
+                items.setdefault(entry[1].lower(), []).append(item)
+                entity_entries[entry[0]] = entry
+
+        names = {}
+        for collection, collection_items in items.items():
+            collection_items.sort()
+            names[collection] = SortedNames(collection_items)
+
+        with self.lock:
+            self.names = names
+            self.entity_entries = entity_entries
+            self.last_updated = max([e.last_updated for e in entities] or
+                                    [None])
+            self.refreshed_at = time.time()
+
+    def refresh(self, interval, overlap):
+        """ Updates the index with any entities updated since the last
+        refresh, if more than interval seconds have passed since then.
+        Timestamps are set when a write starts, but it may commit later, so
+        entities updated up to overlap seconds before the latest timestamp
+        seen are checked again.
+        """
+        if not self.ready or time.time() - self.refreshed_at < interval:
+            return
+
+        self.refreshed_at = time.time()
+        query = db.session.query(Entity).options(
+            joinedload('master_revision.entity_data.default_alias')
+        )
+        if self.last_updated is not None:
+            query = query.filter(
+                Entity.last_updated >=
+                self.last_updated - timedelta(seconds=overlap)
+            )
+        entities = query.all()
+
+        with self.lock:
+            for entity in entities:
+                entity_gid = str(entity.entity_gid)
+                entry = self.make_entry(entity)
+
+                # Entities seen in the last refresh are usually unchanged
+                if self.entity_entries.get(entity_gid) != entry:
+                    self.remove(entity_gid)
+                    if entry is not None:
+                        self.insert(entry)
+
+                if (self.last_updated is None or
+                        entity.last_updated > self.last_updated):
+                    self.last_updated = entity.last_updated
+
+    @staticmethod
+    def make_entry(entity):
+        revision = entity.master_revision
+        if revision is None or revision.entity_data is None:
+            return None
+
+        alias = revision.entity_data.default_alias
+        if alias is None or not alias.name:
+            return None
+
+        return (str(entity.entity_gid), entity._type, alias.name)
+
+    def insert(self, entry):
+        key = normalize_name(entry[2])
+        self.names[None].insert(key, entry)
+        self.names.setdefault(entry[1].lower(), SortedNames()).\
+            insert(key, entry)
+        self.entity_entries[entry[0]] = entry
+
+    def remove(self, entity_gid):
+        entry = self.entity_entries.pop(entity_gid, None)
+        if entry is None:
+            return
+
+        key = normalize_name(entry[2])
+        self.names[None].remove(key, entity_gid)
+        self.names[entry[1].lower()].remove(key, entity_gid)
+
+    def search(self, params):
+        """ Returns the entities with default alias names starting with the
+        query, in the same format as Elasticsearch search hits.
+        """
+        prefix = normalize_name(params['q'])
+        first, last = params['from'], params['from'] + params['size']
+
+        with self.lock:
+            names = self.names.get(params['collection'], SortedNames())
+            low, high = names.prefix_range(prefix)
+            total = high - low
+            matches = names.entries[low + first:min(low + last, high)]
+
+        return {
+            'total': total,
+            'max_score': None,
+            'hits': [{
+                '_id': entity_gid,
+                '_type': entity_type.lower(),
+                '_score': None,
+                '_source': {
+                    'entity_gid': entity_gid,
+                    'type': entity_type,
+                    'default_alias': {'name': name}
+                }
+            } for entity_gid, entity_type, name in matches],
+            'next_cursor': None
+        }
+
+
+autocomplete_index = AutocompleteIndex()
@@ -22,28 +22,26 @@ should be kept to a minimum.
 """
 
 
-from bbschema import Creator, Edition, Entity, Publication, Publisher, Work
-from elasticsearch import Elasticsearch
-from flask import jsonify, request
+from bbschema import Entity
+from flask import current_app, jsonify, request
 from flask_restful import abort, marshal
-from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.exc import NoResultFound
 
 from . import structures
+from .autocomplete import autocomplete_index
+from .search import (get_cached_hits, hydrate_hits, parse_multi_search_args,
+                     parse_search_args, reindex, route_query,
+                     run_multi_search, run_search, search_cache_key,
+                     set_cached_hits)
 from .services import cache, db
-from .util import index_entity, is_uuid
-
-
-TYPE_MAP = {
-    Creator: structures.CREATOR_DATA,
-    Publication: structures.PUBLICATION_DATA,
-    Edition: structures.EDITION_DATA,
-    Publisher: structures.PUBLISHER_DATA,
-    Work: structures.WORK_DATA
-}
+from .util import METRICS_KEY, es_breaker
 
 
 def init(app):
+    if app.config.get('AUTOCOMPLETE_INDEX', False):
+        with app.app_context():
+            autocomplete_index.build()
+
     # Book of the Week
     @app.route('/botw', methods=['GET'])
     def botw():
@@ -60,73 +58,86 @@ def init(app):
 
         return jsonify(marshal(entity, structures.ENTITY))
 
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        # pylint: disable=unused-variable
+        counters = cache.hgetall(METRICS_KEY) or {}
+        metrics = {name: int(value) for name, value in counters.items()}
+
+        # The breaker is per-process, so this reflects the serving process
+        metrics['elasticsearch_breaker_open'] = int(es_breaker.is_open)
+
+        return jsonify(metrics)
+
     @app.route('/search/', endpoint='search_query', methods=['GET'])
     def search():
         # pylint: disable=unused-variable
-        query = request.args.get('q', '')
-        mode = request.args.get('mode', 'search')
-        collection = request.args.get('collection')
-
-        if collection not in ['creator',
-                              'publication',
-                              'edition',
-                              'publisher',
-                              'work']:
-            collection = None
-
-        if is_uuid(query):
-            # Query by UUID, directly against stored IDs
-            query_obj = {
-                'query': {
-                    'ids': {
-                        "values": [query]
-                    }
-                }
-            }
-        else:
-            search_field = 'default_alias.name'
-
-            if mode == 'search':
-                search_field += '.search'
-            elif mode == 'auto':
-                search_field += '.autocomplete'
-
-            query_obj = {
-                'query': {
-                    'match': {
-                        search_field: {
-                            'query': query,
-                            'minimum_should_match': '80%'
-                        }
-                    }
-                }
-            }
-
-        es_conn = Elasticsearch()
-        results = es_conn.search(
-            index='bookbrainz',
-            doc_type=collection,
-            body=query_obj
+        params = parse_search_args(request.args)
+
+        # UUID and identifier queries are answered from the database
+        hits = route_query(params)
+
+        if (hits is None and params['mode'] == 'auto' and
+                autocomplete_index.ready and
+                params['search_after'] is None and not params['facets']):
+            autocomplete_index.refresh(
+                current_app.config.get('AUTOCOMPLETE_REFRESH_INTERVAL', 10),
+                current_app.config.get('AUTOCOMPLETE_REFRESH_OVERLAP', 60)
+            )
+            hits = autocomplete_index.search(params)
+
+        if hits is None:
+            key = search_cache_key(params)
+            hits = get_cached_hits(key)
+            if hits is None:
+                hits = run_search(params)
+
+                # Don't keep degraded results from the fallback backend
+                if not hits.get('degraded'):
+                    set_cached_hits(key, hits)
+
+        # Hits are hydrated after caching, so that edits to the entities
+        # are never served from the cache
+        if params['hydrate'] is not None:
+            hits = hydrate_hits(hits, params['hydrate'])
+
+        return jsonify(hits)
+
+    @app.route('/search/multi', endpoint='search_multi', methods=['POST'])
+    def multi_search():
+        # pylint: disable=unused-variable
+        all_params = parse_multi_search_args(
+            request.get_json(force=True, silent=True)
         )
 
-        return jsonify(results['hits'])
+        # UUID and identifier queries are answered from the database, and
+        # the rest from the cache if possible
+        responses = [route_query(params) for params in all_params]
+        keys = {i: search_cache_key(params)
+                for i, params in enumerate(all_params)
+                if responses[i] is None}
+        for i, key in keys.items():
+            responses[i] = get_cached_hits(key)
+
+        # Run all of the queries which missed the cache together
+        missing = [i for i, hits in enumerate(responses) if hits is None]
+        if missing:
+            results = run_multi_search([all_params[i] for i in missing])
+
+            for i, hits in zip(missing, results):
+                if 'error' not in hits and not hits.get('degraded'):
+                    set_cached_hits(keys[i], hits)
+                responses[i] = hits
+
+        for params, hits in zip(all_params, responses):
+            if params['hydrate'] is not None and 'error' not in hits:
+                hydrate_hits(hits, params['hydrate'])
+
+        return jsonify({'responses': responses})
 
     @app.route('/search/reindex', endpoint='search_reindex', methods=['GET'])
     def reindex_search():
         # pylint: disable=unused-variable
-        entities = db.session.query(Entity).options(
-            joinedload('master_revision.entity_data')
-        ).all()
-
-        es_conn = Elasticsearch()
-        for entity in entities:
-            if (entity.master_revision is not None and
-                    entity.master_revision.entity_data is not None):
-                entity_out = marshal(entity, structures.ENTITY_EXPANDED)
-                data_out = marshal(entity.master_revision.entity_data,
-                                   TYPE_MAP[type(entity)])
-
-                entity_out.update(data_out)
-                index_entity(es_conn, entity_out)
-
-        return jsonify({'success': True})
+        index_names = reindex()
+
+        return jsonify({'success': True, 'indices': index_names})
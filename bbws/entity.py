@@ -22,24 +22,59 @@ resources.
 """
 
 
+import json
 import traceback
+from collections import OrderedDict
 
 from bbschema import (Creator, CreatorData, Edition, EditionData, Entity,
-                      EntityData, EntityRevision, IdentifierType, Publication,
-                      PublicationData, Publisher, PublisherData, RevisionNote,
-                      Work, WorkData, Language, User)
-from elasticsearch import Elasticsearch, ElasticsearchException
-from flask import request
-from flask_restful import Resource, abort, fields, marshal, reqparse
+                      EntityData, EntityRevision, Identifier, IdentifierType,
+                      Publication, PublicationData, Publisher, PublisherData,
+                      RevisionNote, Work, WorkData, Language, User)
+from elasticsearch import ElasticsearchException
+from flask import current_app, request, stream_with_context
+from flask_restful import (Resource, abort, fields, inputs, marshal,
+                           reqparse)
+from sqlalchemy import func, tuple_
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload, subqueryload
 from sqlalchemy.orm.exc import NoResultFound
 
-from bbws.revision import RevisionResourceList
+from bbws.revision import (DATA_MAPPER, RevisionResourceList,
+                           format_entity_changes, invalidate_revision_cache,
+                           load_data_relations, load_entity_data,
+                           publish_revision)
 
 from . import structures
 from .services import db, oauth_provider
-from .util import index_entity, is_uuid
+from .util import (get_es_connection, index_entity, is_uuid,
+                   retry_transaction, search_document, unindex_entity)
+
+
+def revision_at(entity_gid, timestamp, *options):
+    """ Returns the revision of the specified entity which was in effect at the
+    given time, or None if the entity had no revisions at that time. The
+    timestamp is compared against revision creation times in UTC.
+    """
+    if timestamp.tzinfo is not None:
+        timestamp = (timestamp - timestamp.utcoffset()).replace(tzinfo=None)
+
+    return db.session.query(EntityRevision).options(*options).\
+        filter(EntityRevision.entity_gid == entity_gid).\
+        filter(EntityRevision.created_at <= timestamp).\
+        order_by(EntityRevision.created_at.desc()).first()
+
+
+def query_entities_by_identifiers(pairs):
+    """ Returns a query for (Entity, Identifier) tuples, for the entities
+    whose master revision data has any of the identifiers given as
+    (identifier_type_id, value) pairs.
+    """
+    return db.session.query(Entity, Identifier).\
+        join(EntityRevision, Entity.master_revision).\
+        join(EntityData, EntityRevision.entity_data).\
+        join(Identifier, EntityData.identifiers).\
+        filter(tuple_(Identifier.identifier_type_id,
+                      Identifier.value).in_(pairs))
 
 
 class EntityResource(Resource):
@@ -51,7 +86,10 @@ class EntityResource(Resource):
 
     get_parser = reqparse.RequestParser()
     get_parser.add_argument('revision', type=int, default=None)
+    get_parser.add_argument('at', type=inputs.datetime_from_iso8601,
+                            default=None)
     get_parser.add_argument('user_id', type=int, default=None)
+    get_parser.add_argument('since_revision', type=int, default=None)
 
     entity_class = None
     entity_fields = None
@@ -63,7 +101,10 @@ class EntityResource(Resource):
             abort(404)
 
         args = self.get_parser.parse_args()
-        if args.revision is None:
+        if args.since_revision is not None:
+            return self.get_delta(entity_gid, args.since_revision)
+
+        if args.revision is None and args.at is None:
             try:
                 entity = db.session.query(self.entity_class).options(
                     joinedload('master_revision.entity_data')
@@ -72,6 +113,14 @@ class EntityResource(Resource):
                 abort(404)
             else:
                 revision = entity.master_revision
+        elif args.revision is None:
+            revision = revision_at(entity_gid, args.at,
+                                   joinedload('entity_data'),
+                                   joinedload('entity'))
+            if revision is None:
+                abort(404)
+
+            entity = revision.entity
         else:
             try:
                 revision = db.session.query(EntityRevision).options(
@@ -110,9 +159,95 @@ class EntityResource(Resource):
 
         return entity_out
 
+    def get_delta(self, entity_gid, since_revision):
+        """ Returns only the fields of the entity data which have changed
+        between the specified revision of the entity and its master revision,
+        in the same format as the changes of a revision. If the data hasn't
+        changed, an empty 304 response is returned instead.
+        """
+        try:
+            entity = db.session.query(self.entity_class).options(
+                joinedload('master_revision.entity_data')
+            ).filter_by(entity_gid=entity_gid).one()
+        except NoResultFound:
+            abort(404)
+
+        if entity.master_revision is None:
+            abort(404)
+
+        try:
+            base = db.session.query(EntityRevision).options(
+                joinedload('entity_data')
+            ).filter_by(revision_id=since_revision,
+                        entity_gid=entity_gid).one()
+        except NoResultFound:
+            abort(404)
+
+        master = entity.master_revision
+        if base.entity_data_id == master.entity_data_id:
+            return current_app.response_class(status=304)
+
+        entity_data = master.entity_data
+        if entity_data is None:
+            changes = None
+        else:
+            diff = entity_data.diff(base.entity_data)
+            changes = marshal(diff, DATA_MAPPER[type(entity_data)])
+            changes = {
+                key: value for key, value in changes.items() if key in diff
+            }
+
+        return {
+            'revision_id': master.revision_id,
+            'since_revision_id': base.revision_id,
+            'deleted': entity_data is None,
+            'changes': changes
+        }
+
     @oauth_provider.require_oauth()
+    @retry_transaction
     def put(self, entity_gid):
-        data = request.get_json()
+        return self.update_entity(entity_gid, request.get_json())
+
+    @oauth_provider.require_oauth()
+    @retry_transaction
+    def patch(self, entity_gid):
+        """ Apply a partial update to the master revision of the entity. The
+        body has the same format as a PUT body, in which members that are left
+        out are unchanged, and aliases and identifiers are lists of
+        [id, object] edits rather than replacement lists. It is not a JSON
+        Merge Patch: null members are passed on to the update unchanged. The
+        difference from PUT is that an empty body changes nothing, and the
+        current master revision is returned without creating a new one.
+        """
+        data = request.get_json(force=True, silent=True)
+        if not isinstance(data, dict):
+            abort(400)
+
+        if not data:
+            if not is_uuid(entity_gid):
+                abort(404)
+
+            try:
+                entity = db.session.query(self.entity_class).\
+                    filter_by(entity_gid=entity_gid).one()
+            except NoResultFound:
+                abort(404)
+
+            if entity.master_revision is None:
+                abort(403)
+
+            return marshal(entity.master_revision, {
+                'entity': fields.Nested(self.entity_stub_fields)
+            })
+
+        return self.update_entity(entity_gid, data)
+
+    def update_entity(self, entity_gid, data):
+        """ Create a new revision of the entity, with entity data made by
+        applying the changes in data to the data of the current master
+        revision. Used by both PUT and PATCH.
+        """
 
         # This will be valid here, due to authentication.
         user = request.oauth.user
@@ -139,33 +274,35 @@ class EntityResource(Resource):
         revision.entity = entity
         revision.entity_data = entity_data
 
-        note_content = data.get('revision', {}).get('note', '')
+        note_content = revision_data.get('note', '')
 
         if note_content != '':
             note = RevisionNote(user_id=user.user_id,
                                 revision_id=revision.revision_id,
-                                content=data['revision']['note'])
+                                content=note_content)
 
             revision.notes.append(note)
 
+        previous_revision_id = entity.master_revision.revision_id
         entity.master_revision.parent = revision
         entity.master_revision = revision
+
+        # Incremental readers, like the autocomplete index, rely on this
+        entity.last_updated = func.timezone('UTC', func.now())
         entity.revision = revision
 
         db.session.add(revision)
 
         # Commit entity, data and revision
         db.session.commit()
-
-        entity_out = marshal(revision.entity, self.entity_fields)
-        data_out = marshal(revision.entity_data, self.entity_data_fields)
-
-        entity_out.update(data_out)
+        invalidate_revision_cache(previous_revision_id)
+        publish_revision(revision)
 
         # Don't 500 if we fail to index; commit still succeeded
         try:
-            es_conn = Elasticsearch()
-            index_entity(es_conn, entity_out)
+            index_entity(get_es_connection(), search_document(
+                revision.entity, revision.entity_data
+            ))
         except ElasticsearchException:
             pass
 
@@ -174,6 +311,7 @@ class EntityResource(Resource):
         })
 
     @oauth_provider.require_oauth()
+    @retry_transaction
     def delete(self, entity_gid):
         data = request.get_json()
 
@@ -213,30 +351,193 @@ class EntityResource(Resource):
 
             revision.notes.append(note)
 
+        previous_revision_id = entity.master_revision.revision_id
         entity.master_revision.parent = revision
         entity.master_revision = revision
 
+        # Incremental readers, like the autocomplete index, rely on this
+        entity.last_updated = func.timezone('UTC', func.now())
+
         db.session.add(revision)
 
         # Commit entity, data and revision
         db.session.commit()
+        invalidate_revision_cache(previous_revision_id)
+        publish_revision(revision)
+
+        # Don't 500 if we fail to unindex; commit still succeeded
+        try:
+            unindex_entity(get_es_connection(), entity)
+        except ElasticsearchException:
+            pass
 
         return marshal(revision, {
             'entity': fields.Nested(self.entity_stub_fields)
         })
 
 
+class EntityRevertResource(Resource):
+    """ Defines the endpoint for reverting an entity to the data of one of its
+    earlier revisions. The new revision re-uses the immutable EntityData row of
+    the target revision, rather than copying it.
+    """
+
+    entity_class = None
+    entity_data_fields = None
+    entity_stub_fields = None
+
+    @oauth_provider.require_oauth()
+    @retry_transaction
+    def post(self, entity_gid):
+        data = request.get_json(force=True, silent=True)
+        if not isinstance(data, dict):
+            abort(400)
+
+        target_id = data.get('revision_id')
+        if not isinstance(target_id, (int, long)) or \
+                isinstance(target_id, bool):
+            abort(400)
+
+        revision_data = data.get('revision', {})
+        if not isinstance(revision_data, dict) or \
+                not isinstance(revision_data.get('note', ''), basestring):
+            abort(400)
+
+        # This will be valid here, due to authentication.
+        user = request.oauth.user
+        user.total_revisions += 1
+        user.revisions_applied += 1
+
+        if not is_uuid(entity_gid):
+            abort(404)
+
+        try:
+            entity = db.session.query(self.entity_class).options(
+                joinedload('master_revision')
+            ).filter_by(entity_gid=entity_gid).one()
+        except NoResultFound:
+            abort(404)
+
+        if entity.master_revision is None:
+            abort(403)  # Forbidden to revert an entity with no data yet
+
+        try:
+            target = db.session.query(EntityRevision).options(
+                joinedload('entity_data')
+            ).filter_by(revision_id=target_id, entity_gid=entity_gid).one()
+        except NoResultFound:
+            abort(404)
+
+        if target.entity_data_id == entity.master_revision.entity_data_id:
+            abort(400)  # Nothing to revert
+
+        revision = EntityRevision(user_id=user.user_id)
+        revision.entity = entity
+        revision.entity_data = target.entity_data
+
+        note_content = data.get('revision', {}).get('note', '')
+
+        if note_content != '':
+            note = RevisionNote(user_id=user.user_id,
+                                revision_id=revision.revision_id,
+                                content=data['revision']['note'])
+
+            revision.notes.append(note)
+
+        previous_revision_id = entity.master_revision.revision_id
+        entity.master_revision.parent = revision
+        entity.master_revision = revision
+
+        # Incremental readers, like the autocomplete index, rely on this
+        entity.last_updated = func.timezone('UTC', func.now())
+
+        db.session.add(revision)
+
+        # Commit entity and revision - the data already exists
+        db.session.commit()
+        invalidate_revision_cache(previous_revision_id)
+        publish_revision(revision)
+
+        # Don't 500 if we fail to index; commit still succeeded
+        try:
+            if revision.entity_data is None:
+                unindex_entity(get_es_connection(), entity)
+            else:
+                index_entity(get_es_connection(), search_document(
+                    revision.entity, revision.entity_data
+                ))
+        except ElasticsearchException:
+            pass
+
+        return marshal(revision, {
+            'entity': fields.Nested(self.entity_stub_fields)
+        })
+
+
+class EntityHistoryResource(Resource):
+    """ Defines the endpoint for the full history of an entity, which streams
+    a JSON array of all of its revisions, oldest first. Each revision includes
+    its changes from the revision before it. The data of every revision, and
+    the relations compared by the diffs, are loaded in a few queries before
+    the diffs are made.
+    """
+
+    entity_class = None
+
+    def get(self, entity_gid):
+        if not is_uuid(entity_gid):
+            abort(404)
+
+        try:
+            db.session.query(self.entity_class).\
+                filter_by(entity_gid=entity_gid).one()
+        except NoResultFound:
+            abort(404)
+
+        revisions = db.session.query(EntityRevision).options(
+            joinedload('user'), subqueryload('notes')
+        ).filter_by(entity_gid=entity_gid).order_by(
+            EntityRevision.created_at, EntityRevision.revision_id
+        ).all()
+
+        load_entity_data(revisions)
+        load_data_relations(
+            (revision.entity_data for revision in revisions), diff=True
+        )
+
+        def generate():
+            yield '['
+
+            previous = None
+            for revision in revisions:
+                if previous is None:
+                    revision_out = format_entity_changes(revision, [])
+                else:
+                    yield ','
+                    revision_out = format_entity_changes(revision, [previous])
+
+                yield json.dumps(revision_out)
+                previous = revision
+
+            yield ']'
+
+        return current_app.response_class(stream_with_context(generate()),
+                                          mimetype='application/json')
+
+
 class EntityAliasResource(Resource):
 
     get_parser = reqparse.RequestParser()
     get_parser.add_argument('revision', type=int, default=None)
+    get_parser.add_argument('at', type=inputs.datetime_from_iso8601,
+                            default=None)
 
     def get(self, entity_gid):
         if not is_uuid(entity_gid):
             abort(404)
 
         args = self.get_parser.parse_args()
-        if args.revision is None:
+        if args.revision is None and args.at is None:
             try:
                 entity = db.session.query(Entity).options(
                     joinedload('master_revision.entity_data.aliases')
@@ -245,6 +546,11 @@ class EntityAliasResource(Resource):
                 abort(404)
             else:
                 revision = entity.master_revision
+        elif args.revision is None:
+            revision = revision_at(entity_gid, args.at,
+                                   joinedload('entity_data.aliases'))
+            if revision is None:
+                abort(404)
         else:
             try:
                 revision = db.session.query(EntityRevision).options(
@@ -274,13 +580,15 @@ class EntityAliasResource(Resource):
 class EntityDisambiguationResource(Resource):
     get_parser = reqparse.RequestParser()
     get_parser.add_argument('revision', type=int, default=None)
+    get_parser.add_argument('at', type=inputs.datetime_from_iso8601,
+                            default=None)
 
     def get(self, entity_gid):
         if not is_uuid(entity_gid):
             abort(404)
 
         args = self.get_parser.parse_args()
-        if args.revision is None:
+        if args.revision is None and args.at is None:
             try:
                 entity = db.session.query(Entity).options(
                     joinedload('master_revision.entity_data.disambiguation')
@@ -289,6 +597,11 @@ class EntityDisambiguationResource(Resource):
                 abort(404)
             else:
                 revision = entity.master_revision
+        elif args.revision is None:
+            revision = revision_at(entity_gid, args.at,
+                                   joinedload('entity_data.disambiguation'))
+            if revision is None:
+                abort(404)
         else:
             try:
                 revision = db.session.query(EntityRevision).options(
@@ -317,13 +630,15 @@ class EntityDisambiguationResource(Resource):
 class EntityAnnotationResource(Resource):
     get_parser = reqparse.RequestParser()
     get_parser.add_argument('revision', type=int, default=None)
+    get_parser.add_argument('at', type=inputs.datetime_from_iso8601,
+                            default=None)
 
     def get(self, entity_gid):
         if not is_uuid(entity_gid):
             abort(404)
 
         args = self.get_parser.parse_args()
-        if args.revision is None:
+        if args.revision is None and args.at is None:
             try:
                 entity = db.session.query(Entity).options(
                     joinedload('master_revision.entity_data.annotation')
@@ -332,6 +647,11 @@ class EntityAnnotationResource(Resource):
                 abort(404)
             else:
                 revision = entity.master_revision
+        elif args.revision is None:
+            revision = revision_at(entity_gid, args.at,
+                                   joinedload('entity_data.annotation'))
+            if revision is None:
+                abort(404)
         else:
             try:
                 revision = db.session.query(EntityRevision).options(
@@ -360,10 +680,12 @@ class EntityAnnotationResource(Resource):
 class EntityIdentifierResource(Resource):
     get_parser = reqparse.RequestParser()
     get_parser.add_argument('revision', type=int, default=None)
+    get_parser.add_argument('at', type=inputs.datetime_from_iso8601,
+                            default=None)
 
     def get(self, entity_gid):
         args = self.get_parser.parse_args()
-        if args.revision is None:
+        if args.revision is None and args.at is None:
             try:
                 entity = db.session.query(Entity).options(
                     joinedload('master_revision.entity_data.identifiers')
@@ -372,6 +694,11 @@ class EntityIdentifierResource(Resource):
                 abort(404)
             else:
                 revision = entity.master_revision
+        elif args.revision is None:
+            revision = revision_at(entity_gid, args.at,
+                                   joinedload('entity_data.identifiers'))
+            if revision is None:
+                abort(404)
         else:
             try:
                 revision = db.session.query(EntityRevision).options(
@@ -409,6 +736,62 @@ class EntityIdentifierTypeResourceList(Resource):
         }, structures.IDENTIFIER_TYPE_LIST)
 
 
+class EntityIdentifierLookupResource(Resource):
+    def post(self):
+        """ Find the current entities with each of the identifiers in the
+        request body, given as a list of objects with identifier_type_id and
+        value keys. All of the identifiers are looked up in a single query.
+        Identifiers which don't belong to any entity are listed separately.
+        """
+        data = request.get_json()
+
+        identifiers = data.get('identifiers') if data else None
+        if not isinstance(identifiers, list):
+            abort(400)
+
+        if len(identifiers) > \
+                current_app.config.get('IDENTIFIER_LOOKUP_MAX', 5000):
+            abort(400)
+
+        matches = OrderedDict()
+        for identifier in identifiers:
+            try:
+                pair = (int(identifier['identifier_type_id']),
+                        unicode(identifier['value']))
+            except (KeyError, TypeError, ValueError):
+                abort(400)
+
+            matches[pair] = []
+
+        if matches:
+            results = query_entities_by_identifiers(matches.keys()).all()
+            for entity, identifier in results:
+                pair = (identifier.identifier_type_id, identifier.value)
+                if entity not in matches[pair]:
+                    matches[pair].append(entity)
+
+        found = []
+        unknown = []
+        for (identifier_type_id, value), entities in matches.items():
+            result = {
+                'identifier_type_id': identifier_type_id,
+                'value': value,
+                'entities': entities
+            }
+
+            if entities:
+                found.append(result)
+            else:
+                unknown.append(result)
+
+        return marshal({
+            'offset': 0,
+            'count': len(found),
+            'objects': found,
+            'unknown': unknown
+        }, structures.IDENTIFIER_LOOKUP_LIST)
+
+
 class EntityResourceList(Resource):
     get_parser = reqparse.RequestParser()
     get_parser.add_argument('limit', type=int, default=20)
@@ -437,6 +820,7 @@ class EntityResourceList(Resource):
         }, self.entity_list_fields)
 
     @oauth_provider.require_oauth()
+    @retry_transaction
     def post(self):
         data = request.get_json()
 
@@ -476,15 +860,13 @@ class EntityResourceList(Resource):
             print traceback.format_exc()
             abort(400)
 
-        entity_out = marshal(revision.entity, structures.ENTITY_EXPANDED)
-        data_out = marshal(revision.entity_data, self.entity_data_fields)
-
-        entity_out.update(data_out)
+        publish_revision(revision)
 
         # Don't 500 if we fail to index; commit still succeeded
         try:
-            es_conn = Elasticsearch()
-            index_entity(es_conn, entity_out)
+            index_entity(get_es_connection(), search_document(
+                revision.entity, revision.entity_data
+            ))
         except ElasticsearchException:
             pass
 
@@ -517,6 +899,30 @@ def make_entity_endpoints(api, entity_class, data_class, make_list=True):
         endpoint='{}_get_single'.format(entity_name)
     )
 
+    revert_class = type(
+        entity_class.__name__ + 'RevertResource', (EntityRevertResource,),
+        {
+            'entity_class': entity_class,
+            'entity_data_fields': data_struct,
+            'entity_stub_fields': stub_struct
+        }
+    )
+
+    api.add_resource(
+        revert_class, '/{}/<string:entity_gid>/revert'.format(entity_name),
+        endpoint='{}_revert'.format(entity_name)
+    )
+
+    history_class = type(
+        entity_class.__name__ + 'HistoryResource', (EntityHistoryResource,),
+        {'entity_class': entity_class}
+    )
+
+    api.add_resource(
+        history_class, '/{}/<string:entity_gid>/history'.format(entity_name),
+        endpoint='{}_history'.format(entity_name)
+    )
+
     api.add_resource(
         EntityAliasResource,
         '/{}/<string:entity_gid>/aliases'.format(entity_name),
@@ -574,6 +980,12 @@ def create_views(api):
         '/identifierType/'
     )
 
+    api.add_resource(
+        EntityIdentifierLookupResource,
+        '/identifier/lookup',
+        endpoint='identifier_lookup'
+    )
+
 
 def get_display_alias_json(entity_data, user, session):
     alias = get_display_alias(entity_data, user, session)
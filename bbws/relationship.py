@@ -29,7 +29,9 @@ from flask_restful import Resource, abort, fields, marshal, reqparse
 from sqlalchemy.orm.exc import NoResultFound
 
 from . import structures
+from .revision import publish_revision
 from .services import db, oauth_provider
+from .util import retry_transaction
 
 
 class RelationshipResource(Resource):
@@ -76,6 +78,7 @@ class RelationshipResourceList(Resource):
         }, structures.RELATIONSHIP_LIST)
 
     @oauth_provider.require_oauth()
+    @retry_transaction
     def post(self):
         json = request.get_json()
 
@@ -100,6 +103,7 @@ class RelationshipResourceList(Resource):
 
         # Commit relationship, data and revision
         db.session.commit()
+        publish_revision(revision)
 
         return marshal(revision, {
             'relationship': fields.Nested(structures.RELATIONSHIP_STUB)
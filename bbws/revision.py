@@ -17,15 +17,35 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
-from bbschema import (CreatorData, EditionData, EntityRevision,
-                      PublicationData, PublisherData, Revision, WorkData)
-from flask_restful import Resource, abort, fields, marshal, reqparse
+import json
+import time
+from datetime import timedelta
+
+from bbschema import (CreatorData, EditionData, Entity, EntityData,
+                      EntityRevision, PublicationData, PublisherData,
+                      RelationshipData, RelationshipRevision, Revision,
+                      WorkData)
+from flask import current_app, request, stream_with_context, url_for
+from flask_restful import Resource, abort, fields, inputs, marshal, reqparse
+from sqlalchemy import func, literal, tuple_
+from sqlalchemy.orm import aliased, joinedload, subqueryload
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm.exc import NoResultFound
 
 from . import structures
-from .services import db
+from .services import cache, db
+from .util import count_metric, decode_cursor, encode_cursor
 
 
+# Marshalled revisions are cached in a hash under this key, with a field for
+# each base they were diffed against. They are invalidated when the
+# revision's parent changes, and expire after REVISION_CACHE_TIMEOUT seconds
+# in case an invalidation is missed.
+REVISION_CACHE_KEY = 'revision_cache:{}'
+
+# Every committed revision is published on this Redis channel
+REVISION_CHANNEL = 'revisions'
+
 DATA_MAPPER = {
     PublicationData: structures.PUBLICATION_DIFF,
     CreatorData: structures.CREATOR_DIFF,
@@ -34,10 +54,194 @@ DATA_MAPPER = {
     WorkData: structures.WORK_DIFF,
 }
 
+EXPORT_MAPPER = {
+    PublicationData: structures.PUBLICATION_DATA,
+    CreatorData: structures.CREATOR_DATA,
+    EditionData: structures.EDITION_DATA,
+    PublisherData: structures.PUBLISHER_DATA,
+    WorkData: structures.WORK_DATA,
+    RelationshipData: structures.RELATIONSHIP_DATA
+}
 
-def format_entity_revision(revision, base):
-    entity_revision_fields = structures.ENTITY_REVISION.copy()
+# Relations of each type of entity data which are marshalled by its DATA
+# structure, so that they can be loaded in bulk
+DATA_RELATIONS = {
+    PublicationData: ['publication_type'],
+    CreatorData: ['creator_type', 'gender'],
+    EditionData: ['creator_credit.names', 'language', 'edition_format',
+                  'edition_status'],
+    PublisherData: ['publisher_type'],
+    WorkData: ['languages', 'work_type'],
+}
+
+
+def invalidate_revision_cache(revision_id):
+    """ Removes the cached output of a revision. This must be called when a
+    new revision is made the parent of an existing one.
+    """
+    cache.delete(REVISION_CACHE_KEY.format(revision_id))
+
+
+def revision_event(revision):
+    """ Builds the event sent to subscribers of the revision stream for a
+    revision, with the fields that the stream can be filtered on.
+    """
+    event = {
+        'revision_id': revision.revision_id,
+        'created_at': revision.created_at.isoformat(),
+        'user_id': revision.user_id,
+        'type': 'relationship',
+        'entity_type': None,
+        'entity_gid': None,
+        'relationship_id': None
+    }
+
+    if isinstance(revision, EntityRevision):
+        event['type'] = 'entity'
+        event['entity_type'] = revision.entity._type.lower()
+        event['entity_gid'] = str(revision.entity_gid)
+    else:
+        event['relationship_id'] = revision.relationship_id
+
+    return event
+
+
+def publish_revision(revision):
+    """ Publishes a revision to the subscribers of the revision stream. This
+    must be called after the revision is committed.
+    """
+    cache.publish(REVISION_CHANNEL, json.dumps(revision_event(revision)))
+
+
+def load_entity_data(revisions):
+    """ Loads the data of the provided entity revisions in one query, and sets
+    it on each revision, so that accessing entity_data doesn't need another
+    query.
+    """
+    revisions = [revision for revision in revisions
+                 if isinstance(revision, EntityRevision) and
+                 revision.entity_data_id is not None]
+    if not revisions:
+        return
+
+    data_ids = set(revision.entity_data_id for revision in revisions)
+    entity_data = db.session.query(EntityData).with_polymorphic('*').\
+        filter(EntityData.entity_data_id.in_(data_ids))
+    data_by_id = {data.entity_data_id: data for data in entity_data}
+
+    for revision in revisions:
+        set_committed_value(revision, 'entity_data',
+                            data_by_id.get(revision.entity_data_id))
+
+
+def load_data_relations(entity_data, diff=False):
+    """ Loads the relations of the provided entity data which are marshalled
+    by the DATA structures, or also those compared by diff() if diff is True,
+    with one query for the relations shared by all entity data and one for
+    those of each type present.
+    """
+    entity_data = [data for data in entity_data if data is not None]
+    if not entity_data:
+        return
+
+    options = [joinedload('default_alias.language')]
+    if diff:
+        options.extend([
+            joinedload('annotation'),
+            joinedload('disambiguation'),
+            subqueryload('aliases').joinedload('language'),
+            subqueryload('identifiers').joinedload('identifier_type')
+        ])
+
+    data_ids = set(data.entity_data_id for data in entity_data)
+    db.session.query(EntityData).with_polymorphic('*').options(
+        *options
+    ).filter(EntityData.entity_data_id.in_(data_ids)).all()
+
+    for data_class, relations in DATA_RELATIONS.items():
+        data_ids = set(data.entity_data_id for data in entity_data
+                       if isinstance(data, data_class))
+        if not data_ids:
+            continue
+
+        db.session.query(data_class).options(
+            *[subqueryload(relation) for relation in relations]
+        ).filter(data_class.entity_data_id.in_(data_ids)).all()
+
+
+def load_revision_entities(revisions):
+    """ Loads the entities of the provided entity revisions in one query, and
+    sets them on each revision, so that revision_event doesn't need a query
+    for each revision.
+    """
+    entity_gids = set(revision.entity_gid for revision in revisions
+                      if isinstance(revision, EntityRevision))
+    if not entity_gids:
+        return
+
+    entities = db.session.query(Entity).\
+        filter(Entity.entity_gid.in_(entity_gids))
+    entities_by_gid = {entity.entity_gid: entity for entity in entities}
+
+    for revision in revisions:
+        if isinstance(revision, EntityRevision):
+            set_committed_value(revision, 'entity',
+                                entities_by_gid.get(revision.entity_gid))
+
+
+def load_export_data(revisions):
+    """ Loads everything needed to export the provided revisions, including
+    the relations of their data, in a few queries.
+    """
+    load_entity_data(revisions)
+    load_revision_entities(revisions)
+
+    load_data_relations(revision.entity_data for revision in revisions
+                        if isinstance(revision, EntityRevision))
+
+    relationship_revisions = [
+        revision for revision in revisions
+        if isinstance(revision, RelationshipRevision) and
+        revision.relationship_data_id is not None
+    ]
+    if not relationship_revisions:
+        return
+
+    data_ids = set(revision.relationship_data_id
+                   for revision in relationship_revisions)
+    relationship_data = db.session.query(RelationshipData).options(
+        joinedload('relationship_type'),
+        subqueryload('entities').joinedload('entity'),
+        subqueryload('texts')
+    ).filter(RelationshipData.relationship_data_id.in_(data_ids))
+    data_by_id = {data.relationship_data_id: data
+                  for data in relationship_data}
+
+    for revision in relationship_revisions:
+        set_committed_value(revision, 'relationship_data',
+                            data_by_id.get(revision.relationship_data_id))
+
+
+def format_export(revision):
+    """ Formats a revision as a line of the revision export, which includes
+    the data of the entity or relationship after the revision.
+    """
+    change = revision_event(revision)
+
+    if isinstance(revision, EntityRevision):
+        data = revision.entity_data
+    else:
+        data = revision.relationship_data
+
+    change['deleted'] = data is None
+    change['data'] = None
+    if data is not None:
+        change['data'] = marshal(data, EXPORT_MAPPER[type(data)])
+
+    return json.dumps(change) + '\n'
 
+
+def format_entity_revision(revision, base):
     if base is None:
         right = revision.children
     else:
@@ -45,7 +249,16 @@ def format_entity_revision(revision, base):
             right = [db.session.query(Revision).
                      filter_by(revision_id=base).one()]
         except NoResultFound:
-            return marshal(revision, entity_revision_fields)
+            return marshal(revision, structures.ENTITY_REVISION)
+
+    return format_entity_changes(revision, right)
+
+
+def format_entity_changes(revision, right):
+    """ Marshals an entity revision, with the changes made to its data by
+    each of the revisions in right.
+    """
+    entity_revision_fields = structures.ENTITY_REVISION.copy()
 
     if revision.entity_data is None:
         return marshal(revision, entity_revision_fields)
@@ -97,6 +310,19 @@ class RevisionResource(Resource):
     def get(self, revision_id):
         args = self.get_parser.parse_args()
 
+        # URIs in the output are absolute, so they depend on the host
+        key = REVISION_CACHE_KEY.format(revision_id)
+        field = u'{}:{}'.format(
+            request.url_root, 'children' if args.base is None else args.base
+        )
+
+        cached = cache.hget(key, field)
+        if cached is not None:
+            count_metric('revision_cache_hits')
+            return json.loads(cached)
+
+        count_metric('revision_cache_misses')
+
         try:
             revision = db.session.query(Revision).\
                 filter_by(revision_id=revision_id).one()
@@ -104,23 +330,70 @@ class RevisionResource(Resource):
             abort(404)
 
         if isinstance(revision, EntityRevision):
-            return format_entity_revision(revision, args.base)
+            revision_out = format_entity_revision(revision, args.base)
         else:
-            return format_relationship_revision(revision, args.base)
+            revision_out = format_relationship_revision(revision, args.base)
+
+        # A missing base may exist later, so only cache completed diffs
+        if args.base is None or 'changes' in revision_out:
+            cache.hset(key, field, json.dumps(revision_out))
+            cache.expire(key, current_app.config.get(
+                'REVISION_CACHE_TIMEOUT', 7 * 24 * 3600
+            ))
+
+            # A new parent committed after the revision was read would have
+            # been invalidated before the output was cached, so check the
+            # parent again now that the output is visible to other requests.
+            parent_id = db.session.query(Revision.parent_id).\
+                filter_by(revision_id=revision_id).scalar()
+            if parent_id != revision.parent_id:
+                cache.delete(key)
+
+        return revision_out
+
+
+def parse_revision_cursor(cursor):
+    """ Decodes a cursor for the next page of a revision list, returning the
+    (created_at, revision_id) of the last revision on the previous page.
+    Aborts with 400 if the cursor is invalid.
+    """
+    values = decode_cursor(cursor)
+    if values is None or len(values) != 2:
+        abort(400)
+
+    try:
+        return inputs.datetime_from_iso8601(values[0]), int(values[1])
+    except (TypeError, ValueError):
+        abort(400)
 
 
 class RevisionResourceList(Resource):
+    """ Lists revisions, newest first. Pages can be requested with offset, or
+    with the next_cursor of the previous page, which is as fast for pages deep
+    into the history as for the first page.
+    """
+
     get_parser = reqparse.RequestParser()
     get_parser.add_argument('type', type=str)
     get_parser.add_argument('limit', type=int, default=20)
     get_parser.add_argument('offset', type=int, default=0)
+    get_parser.add_argument('cursor', type=str, default=None)
 
     def get(self, entity_gid=None, user_id=None):
         args = self.get_parser.parse_args()
-        query = db.session.query(Revision)
+
+        # Only entity revisions have an entity to load with them
+        if entity_gid is not None or args.type == 'entity':
+            query = db.session.query(EntityRevision).options(
+                joinedload('entity')
+            )
+        else:
+            query = db.session.query(Revision)
+
+        # Load everything that is marshalled with the page of revisions
+        query = query.options(joinedload('user'), subqueryload('notes'))
 
         if entity_gid is not None:
-            query = db.session.query(EntityRevision)
             query = query.filter_by(entity_gid=entity_gid)
         elif user_id is not None:
             query = query.filter_by(user_id=user_id)
@@ -131,19 +404,383 @@ class RevisionResourceList(Resource):
             query = query.filter_by(_type=1)
             list_fields = structures.ENTITY_REVISION_LIST
 
-        revisions = query.order_by(Revision.created_at.desc()).\
-            offset(args.offset).limit(args.limit).all()
+        if args.cursor is not None:
+            if args.offset != 0:
+                abort(400)
+
+            query = query.filter(
+                tuple_(Revision.created_at, Revision.revision_id) <
+                tuple_(*parse_revision_cursor(args.cursor))
+            )
+
+        revisions = query.order_by(
+            Revision.created_at.desc(), Revision.revision_id.desc()
+        ).offset(args.offset).limit(args.limit).all()
+
+        next_cursor = None
+        if revisions and len(revisions) == args.limit:
+            last = revisions[-1]
+            next_cursor = encode_cursor(
+                [last.created_at.isoformat(), last.revision_id]
+            )
 
         return marshal({
             'offset': args.offset,
             'count': len(revisions),
+            'next_cursor': next_cursor,
             'objects': revisions
         }, list_fields)
 
 
+def query_related_revisions(revision_id, ancestors, max_depth):
+    """ Returns a query for the revisions related to a revision through its
+    parent links, nearest first. Ancestors are found by following parent_id,
+    and descendants by following it in reverse. The links are followed by one
+    recursive CTE, up to max_depth steps.
+    """
+    related = db.session.query(
+        Revision.revision_id, Revision.parent_id,
+        literal(0).label('depth')
+    ).filter(Revision.revision_id == revision_id).\
+        cte('related_revisions', recursive=True)
+
+    step = aliased(Revision)
+    if ancestors:
+        link = step.revision_id == related.c.parent_id
+    else:
+        link = step.parent_id == related.c.revision_id
+
+    related = related.union_all(
+        db.session.query(
+            step.revision_id, step.parent_id, related.c.depth + 1
+        ).filter(link, related.c.depth < max_depth)
+    )
+
+    return db.session.query(Revision).\
+        join(related, Revision.revision_id == related.c.revision_id).\
+        filter(related.c.depth > 0).\
+        order_by(related.c.depth, Revision.revision_id)
+
+
+class RevisionRelativesResource(Resource):
+    """ Lists the ancestors or descendants of a revision, nearest first. """
+
+    ancestors = None
+
+    get_parser = reqparse.RequestParser()
+    get_parser.add_argument('depth', type=int, default=100)
+    get_parser.add_argument('limit', type=int, default=20)
+    get_parser.add_argument('offset', type=int, default=0)
+
+    def get(self, revision_id):
+        args = self.get_parser.parse_args()
+
+        if args.depth < 1:
+            abort(400)
+
+        if not db.session.query(Revision).\
+                filter_by(revision_id=revision_id).count():
+            abort(404)
+
+        query = query_related_revisions(revision_id, self.ancestors,
+                                        args.depth)
+        revisions = query.options(
+            joinedload('user'), subqueryload('notes')
+        ).offset(args.offset).limit(args.limit).all()
+
+        return marshal({
+            'offset': args.offset,
+            'count': len(revisions),
+            'next_cursor': None,
+            'objects': revisions
+        }, structures.REVISION_LIST)
+
+
+class RevisionAncestorsResource(RevisionRelativesResource):
+    ancestors = True
+
+
+class RevisionDescendantsResource(RevisionRelativesResource):
+    ancestors = False
+
+
+def revision_matches(event, args):
+    """ Tests whether a revision event passes the filters of a request to the
+    revision stream.
+    """
+    if args.type is not None and \
+            args.type not in (event['type'], event['entity_type']):
+        return False
+
+    if args.entity is not None and event['entity_gid'] != args.entity:
+        return False
+
+    if args.user is not None and event['user_id'] != args.user:
+        return False
+
+    return True
+
+
+def format_event(event):
+    return 'id: {}\nevent: revision\ndata: {}\n\n'.format(
+        event['revision_id'], json.dumps(event)
+    )
+
+
+def gap_event(since):
+    """ Builds the event sent in place of the revisions missed since a
+    revision ID, when there are too many to catch up on from the stream. The
+    client should read them from the revision export instead.
+    """
+    return {
+        'since': since,
+        'export_uri': url_for('revision_export', after=since, _external=True)
+    }
+
+
+def format_gap(gap):
+    # Gaps have no ID, so a reconnecting client still resumes from since
+    return 'event: gap\ndata: {}\n\n'.format(json.dumps(gap))
+
+
+class RevisionStreamResource(Resource):
+    """ Pushes revisions to clients as they are committed, as server-sent
+    events or, if poll is set, in the response to a long poll. Revisions can
+    be filtered by type (entity, relationship or an entity type), entity GID
+    and user ID. New revisions are received through a Redis channel, so
+    waiting clients don't query the database. Clients can catch up on the
+    revisions after since, or the Last-Event-ID of a reconnecting stream. If
+    more than REVISION_STREAM_BACKLOG revisions were missed, they are replaced
+    by a gap, which points to the revision export.
+    """
+
+    get_parser = reqparse.RequestParser()
+    get_parser.add_argument('type', type=str, default=None)
+    get_parser.add_argument('entity', type=str, default=None)
+    get_parser.add_argument('user', type=int, default=None)
+    get_parser.add_argument('since', type=int, default=None)
+    get_parser.add_argument('poll', type=inputs.boolean, default=False)
+    get_parser.add_argument('timeout', type=int, default=None)
+
+    def get(self):
+        args = self.get_parser.parse_args()
+
+        since = args.since
+        if since is None and 'Last-Event-ID' in request.headers:
+            try:
+                since = int(request.headers['Last-Event-ID'])
+            except ValueError:
+                abort(400)
+
+        # Subscribe before looking for missed revisions, so that revisions
+        # committed in between are not lost.
+        pubsub = cache.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(REVISION_CHANNEL)
+
+        missed = []
+        gap = None
+        if since is not None:
+            missed, complete = self.missed_events(since)
+            if complete:
+                missed = [event for event in missed
+                          if revision_matches(event, args)]
+            else:
+                missed = []
+                gap = gap_event(since)
+
+        # Waiting for revisions doesn't need the database, so don't hold on
+        # to a connection while blocked on the channel.
+        db.session.remove()
+
+        if args.poll:
+            try:
+                return self.poll(pubsub, missed, gap, args)
+            finally:
+                pubsub.close()
+
+        return current_app.response_class(
+            stream_with_context(self.stream(pubsub, missed, gap, args)),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+
+    @staticmethod
+    def missed_events(since):
+        """ Returns the events of up to REVISION_STREAM_BACKLOG revisions
+        after since, and whether they are all of the revisions after since.
+        """
+        backlog = current_app.config.get('REVISION_STREAM_BACKLOG', 100)
+
+        # One extra revision shows whether any were left out
+        revisions = db.session.query(Revision).\
+            filter(Revision.revision_id > since).\
+            order_by(Revision.revision_id).\
+            limit(backlog + 1).all()
+
+        load_revision_entities(revisions)
+
+        events = [revision_event(revision) for revision in revisions[:backlog]]
+        return events, len(revisions) <= backlog
+
+    @staticmethod
+    def receive(pubsub, timeout, args, sent):
+        """ Waits up to timeout seconds for a message on the revision channel,
+        returning its event if it passes the filters and has not already been
+        sent, or None otherwise.
+        """
+        message = pubsub.get_message(timeout=timeout)
+        if message is None:
+            return None
+
+        event = json.loads(message['data'])
+        if event['revision_id'] in sent or not revision_matches(event, args):
+            return None
+
+        return event
+
+    def poll(self, pubsub, events, gap, args):
+        if gap is not None:
+            return {
+                'count': 0,
+                'objects': [],
+                'gap': gap
+            }
+
+        max_timeout = current_app.config.get('REVISION_POLL_TIMEOUT', 30)
+        timeout = max_timeout if args.timeout is None else \
+            min(args.timeout, max_timeout)
+
+        sent = set(event['revision_id'] for event in events)
+        deadline = time.time() + timeout
+        while not events and time.time() < deadline:
+            event = self.receive(pubsub, deadline - time.time(), args, sent)
+            if event is not None:
+                events.append(event)
+
+        if not events:
+            return current_app.response_class(status=204)
+
+        return {
+            'count': len(events),
+            'objects': events,
+            'gap': None
+        }
+
+    def stream(self, pubsub, events, gap, args):
+        keepalive = current_app.config.get('REVISION_STREAM_KEEPALIVE', 15)
+
+        try:
+            if gap is not None:
+                yield format_gap(gap)
+
+            sent = set()
+            for event in events:
+                sent.add(event['revision_id'])
+                yield format_event(event)
+
+            last_write = time.time()
+            while True:
+                event = self.receive(pubsub, keepalive, args, sent)
+                if event is not None:
+                    yield format_event(event)
+                    last_write = time.time()
+                elif time.time() - last_write >= keepalive:
+                    # Comment lines stop proxies closing idle connections
+                    yield ': keepalive\n\n'
+                    last_write = time.time()
+        finally:
+            pubsub.close()
+
+
+def iter_chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+class RevisionExportResource(Resource):
+    """ Streams every revision after a revision ID, in ascending order, as
+    newline-delimited JSON. Each line includes the data of the entity or
+    relationship after the revision. The stream ends with a resume token,
+    which can be passed back as resume to continue from the last revision.
+    Revisions are read from a server-side cursor, in chunks.
+
+    Revision IDs are assigned before commit, so a revision can become visible
+    after one with a higher ID. To avoid skipping it on resume, the export
+    stops before the first revision created in the last REVISION_EXPORT_LAG
+    seconds, which may still have uncommitted predecessors.
+    """
+
+    get_parser = reqparse.RequestParser()
+    get_parser.add_argument('after', type=int, default=0)
+    get_parser.add_argument('resume', type=str, default=None)
+
+    def get(self):
+        args = self.get_parser.parse_args()
+
+        after = args.after
+        if args.resume is not None:
+            values = decode_cursor(args.resume)
+            if values is None or len(values) != 1 or \
+                    not isinstance(values[0], (int, long)):
+                abort(400)
+
+            after = values[0]
+
+        # Revisions are created in UTC, without a time zone
+        lag = current_app.config.get('REVISION_EXPORT_LAG', 60)
+        cutoff = func.timezone('UTC', func.now()) - timedelta(seconds=lag)
+        watermark = db.session.query(func.min(Revision.revision_id)).filter(
+            Revision.revision_id > after,
+            Revision.created_at >= cutoff
+        ).scalar()
+
+        chunk_size = current_app.config.get('REVISION_EXPORT_CHUNK', 1000)
+        revisions = db.session.query(Revision).\
+            filter(Revision.revision_id > after)
+        if watermark is not None:
+            revisions = revisions.filter(Revision.revision_id < watermark)
+
+        revisions = revisions.order_by(Revision.revision_id).\
+            execution_options(stream_results=True).\
+            yield_per(chunk_size)
+
+        def generate():
+            last_revision_id = after
+            for chunk in iter_chunks(revisions, chunk_size):
+                load_export_data(chunk)
+                for revision in chunk:
+                    yield format_export(revision)
+
+                last_revision_id = chunk[-1].revision_id
+
+            yield json.dumps({
+                'resume_token': encode_cursor([last_revision_id])
+            }) + '\n'
+
+        return current_app.response_class(stream_with_context(generate()),
+                                          mimetype='application/x-ndjson')
+
+
 def create_views(api):
     api.add_resource(RevisionResource, '/revision/<int:revision_id>/',
                      endpoint='revision_get_single')
+    api.add_resource(RevisionExportResource, '/revision/export',
+                     endpoint='revision_export')
+    api.add_resource(RevisionStreamResource, '/revision/stream',
+                     endpoint='revision_stream')
+    api.add_resource(RevisionAncestorsResource,
+                     '/revision/<int:revision_id>/ancestors',
+                     endpoint='revision_get_ancestors')
+    api.add_resource(RevisionDescendantsResource,
+                     '/revision/<int:revision_id>/descendants',
+                     endpoint='revision_get_descendants')
     api.add_resource(
         RevisionResourceList, '/revision/', '/user/<int:user_id>/revisions',
         endpoint='revision_get_many'
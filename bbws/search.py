@@ -0,0 +1,1020 @@
+# -*- coding: utf8 -*-
+
+# Copyright (C) 2016  Ben Ockmore
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+""" This module contains the functions used to validate search arguments and
+build search queries for Elasticsearch, as well as to format the results. It
+also defines the search backends which searches are run on.
+"""
+
+
+import hashlib
+import json
+import os
+import re
+from datetime import datetime
+
+from bbschema import (Alias, Entity, EntityData, EntityRevision,
+                      IdentifierType)
+from elasticsearch import ElasticsearchException, TransportError, helpers
+from flask import current_app
+from flask_restful import abort, marshal
+from sqlalchemy import Float, and_, cast, desc, func, or_
+from sqlalchemy.orm import joinedload, subqueryload
+
+from . import structures
+from .entity import query_entities_by_identifiers
+from .revision import load_data_relations, load_entity_data
+from .services import cache, db
+from .util import (INDEX_ALIAS, SEARCH_GENERATION_KEY, count_metric,
+                   decode_cursor, encode_cursor, es_breaker,
+                   get_es_connection, index_alias, is_unavailable, is_uuid,
+                   search_document)
+
+
+COLLECTIONS = ['creator', 'publication', 'edition', 'publisher', 'work']
+
+HYDRATE_MODES = ['stub', 'full']
+
+TEMPLATE_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'config', 'search-template.json'
+)
+
+# Compiled detection regexes of identifier types, loaded on first use
+identifier_patterns = None
+
+DEFAULT_SIZE = 10
+
+# Facets which can be counted along with search hits, and the fields of the
+# search document that they count
+FACETS = {
+    'type': 'type',
+    'language': 'languages',
+    'edition_format': 'edition_format'
+}
+
+# Sort on score, then entity GID, so that the order of hits is stable enough
+# for search_after cursors to be used between requests.
+SORT_ORDER = [
+    {'_score': 'desc'},
+    {'entity_gid': 'asc'}
+]
+
+# Loads the relations search_document needs which aren't loaded by
+# load_data_relations
+DOCUMENT_OPTIONS = [
+    joinedload('disambiguation'),
+    subqueryload('aliases')
+]
+
+
+def int_arg(args, name, default):
+    """ Gets the named argument from args as a non-negative integer, aborting
+    with 400 if it is invalid.
+    """
+    value = args.get(name, default)
+
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        abort(400)
+
+    if value < 0:
+        abort(400)
+
+    return value
+
+
+def is_sort_values(values):
+    """ Tests whether values are sort values of a hit in SORT_ORDER, a score
+    and an entity GID, as encoded in search_after cursors.
+    """
+    return (isinstance(values, list) and len(values) == len(SORT_ORDER) and
+            isinstance(values[0], (int, long, float)) and
+            not isinstance(values[0], bool) and
+            isinstance(values[1], basestring) and is_uuid(values[1]))
+
+
+def parse_search_args(args):
+    """ Validates the search arguments in args, which may be the query string
+    of a request or an object from a JSON request body, and returns a dict of
+    search parameters. Aborts with 400 if any argument is invalid.
+    """
+
+    collection = args.get('collection')
+    if collection not in COLLECTIONS:
+        collection = None
+
+    params = {
+        'q': u' '.join(args.get('q', u'').split()),
+        'mode': args.get('mode', 'search'),
+        'collection': collection,
+        'size': int_arg(args, 'size', DEFAULT_SIZE),
+        'from': int_arg(args, 'from', 0),
+        'search_after': None,
+        'hydrate': args.get('hydrate'),
+        'facets': []
+    }
+
+    if params['hydrate'] is not None and \
+            params['hydrate'] not in HYDRATE_MODES:
+        abort(400)
+
+    if params['size'] > current_app.config.get('SEARCH_MAX_SIZE', 100):
+        abort(400)
+
+    # Deeper pages must be requested with search_after
+    if params['from'] > current_app.config.get('SEARCH_MAX_FROM', 1000):
+        abort(400)
+
+    # Facets are comma separated in query strings, or a list in JSON bodies
+    facets = args.get('facets') or []
+    if isinstance(facets, basestring):
+        facets = facets.split(',')
+
+    if not isinstance(facets, list) or \
+            any(facet not in FACETS for facet in facets):
+        abort(400)
+
+    params['facets'] = sorted(set(facets))
+
+    cursor = args.get('search_after')
+    if cursor:
+        params['search_after'] = decode_cursor(cursor)
+        if not is_sort_values(params['search_after']):
+            abort(400)
+
+        # Elasticsearch requires "from" to be 0 when using search_after
+        if params['from'] != 0:
+            abort(400)
+
+    return params
+
+
+def parse_multi_search_args(queries):
+    """ Validates the body of a multi-search request, which should be a list
+    of objects with the same arguments as a single search. Returns a list of
+    search parameters, aborting with 400 if the body is invalid.
+    """
+
+    if not isinstance(queries, list) or not queries:
+        abort(400)
+
+    if len(queries) > current_app.config.get('SEARCH_MAX_QUERIES', 20):
+        abort(400)
+
+    all_params = []
+    for query in queries:
+        if not isinstance(query, dict):
+            abort(400)
+
+        all_params.append(parse_search_args(query))
+
+    return all_params
+
+
+def build_header(params):
+    """ Builds the header line for the provided search parameters in an
+    Elasticsearch multi-search request.
+    """
+
+    return {'index': search_index(params)}
+
+
+def search_index(params):
+    """ Returns the alias of the indices to search for the provided search
+    parameters. Type facets count hits in every collection, so all indices
+    are searched, and the collection is applied as a post filter instead.
+    """
+
+    if 'type' in params['facets']:
+        return index_alias()
+
+    return index_alias(params['collection'])
+
+
+def build_query(params):
+    """ Builds the body of an Elasticsearch search request for the provided
+    search parameters.
+    """
+
+    query = params['q']
+
+    if is_uuid(query):
+        # Query by UUID, directly against stored IDs
+        query_obj = {
+            'query': {
+                'ids': {
+                    "values": [query]
+                }
+            }
+        }
+    else:
+        if params['mode'] == 'search':
+            # Matches on any alias count, but the default alias is preferred
+            search_fields = ['default_alias.name.search^2',
+                             'aliases.name.search']
+        elif params['mode'] == 'auto':
+            search_fields = ['default_alias.name.autocomplete']
+        else:
+            search_fields = ['default_alias.name']
+
+        query_obj = {
+            'query': {
+                'multi_match': {
+                    'query': query,
+                    'fields': search_fields,
+                    'minimum_should_match': '80%'
+                }
+            }
+        }
+
+    query_obj.update({
+        'size': params['size'],
+        'from': params['from'],
+        'sort': SORT_ORDER
+    })
+
+    if params['search_after'] is not None:
+        query_obj['search_after'] = params['search_after']
+
+    if params['hydrate'] is not None:
+        # Only IDs are needed, since the entities are loaded from the database
+        query_obj['_source'] = False
+
+    if params['facets']:
+        facet_size = current_app.config.get('SEARCH_FACET_SIZE', 20)
+        query_obj['aggs'] = {
+            facet: {'terms': {'field': FACETS[facet], 'size': facet_size}}
+            for facet in params['facets']
+        }
+
+        if 'type' in params['facets'] and params['collection'] is not None:
+            # Filters the hits, but not the aggregations
+            query_obj['post_filter'] = {
+                'term': {'type': params['collection'].capitalize()}
+            }
+
+    return query_obj
+
+
+def format_facets(aggregations):
+    """ Converts Elasticsearch terms aggregations to lists of values and
+    their counts. Types are given as collection names.
+    """
+
+    facets = {}
+    for facet, aggregation in aggregations.items():
+        facets[facet] = [{
+            'value': (bucket['key'].lower() if facet == 'type'
+                      else bucket['key']),
+            'count': bucket['doc_count']
+        } for bucket in aggregation['buckets']]
+
+    return facets
+
+
+def count_types(types):
+    """ Counts the entity types in types, in the same format as the type
+    facet counts from Elasticsearch.
+    """
+
+    counts = {}
+    for entity_type in types:
+        entity_type = entity_type.lower()
+        counts[entity_type] = counts.get(entity_type, 0) + 1
+
+    return [{'value': value, 'count': count} for value, count in
+            sorted(counts.items(), key=lambda item: (-item[1], item[0]))]
+
+
+def format_hits(hits, params):
+    """ Adds a cursor for the next page of results to the hits returned by
+    Elasticsearch. The cursor is None if this is the last page.
+    """
+
+    if hits['hits'] and len(hits['hits']) == params['size']:
+        hits['next_cursor'] = encode_cursor(hits['hits'][-1]['sort'])
+    else:
+        hits['next_cursor'] = None
+
+    return hits
+
+
+def marshal_source(entity, hydrate):
+    """ Marshals an entity for the source of a search hit, with the STUB
+    structure for its type if hydrate is 'stub', or the full entity and data
+    structures if it is 'full'.
+    """
+
+    struct_name = type(entity).__name__.upper()
+    if hydrate == 'stub':
+        return marshal(entity, getattr(structures, struct_name + '_STUB'))
+
+    revision = entity.master_revision
+    entity.revision = revision
+
+    source = marshal(entity, getattr(structures, struct_name))
+    if revision is not None and revision.entity_data is not None:
+        source.update(marshal(
+            revision.entity_data,
+            getattr(structures, struct_name + '_DATA')
+        ))
+
+    return source
+
+
+def hydrate_hits(hits, hydrate):
+    """ Replaces the source of each hit with the current entity from the
+    database, marshalled according to hydrate. All of the entities are loaded
+    in one query, and their data and its relations in a few more, however
+    many hits there are. Hits for entities which no longer exist are
+    dropped.
+    """
+
+    gids = [hit['_id'] for hit in hits['hits']]
+    if not gids:
+        return hits
+
+    query = db.session.query(Entity).filter(Entity.entity_gid.in_(gids))
+    if hydrate == 'full':
+        query = query.options(joinedload('master_revision.user'))
+
+    entities = {str(entity.entity_gid): entity for entity in query.all()}
+
+    if hydrate == 'full':
+        revisions = [entity.master_revision
+                     for entity in entities.values()]
+        load_entity_data(revisions)
+        load_data_relations(revision.entity_data for revision in revisions
+                            if revision is not None)
+
+    hydrated = []
+    for hit in hits['hits']:
+        entity = entities.get(hit['_id'])
+        if entity is None:
+            continue
+
+        hit['_source'] = marshal_source(entity, hydrate)
+        hydrated.append(hit)
+
+    hits['hits'] = hydrated
+    return hits
+
+
+def get_identifier_patterns():
+    """ Returns a list of (identifier_type_id, compiled detection regex)
+    pairs for all identifier types. The regexes are compiled once, on first
+    use, and invalid regexes are ignored.
+    """
+    global identifier_patterns
+
+    if identifier_patterns is None:
+        patterns = []
+        for identifier_type in db.session.query(IdentifierType).all():
+            if not identifier_type.detection_regex:
+                continue
+
+            try:
+                pattern = re.compile(identifier_type.detection_regex)
+            except re.error:
+                continue
+
+            patterns.append((identifier_type.identifier_type_id, pattern))
+
+        identifier_patterns = patterns
+
+    return identifier_patterns
+
+
+def detect_identifiers(query):
+    """ Returns the (identifier_type_id, value) pairs for the identifier
+    types whose detection regex matches the query. The value is the first
+    group of the match, if the regex has one, or the whole match otherwise.
+    """
+
+    pairs = []
+    for identifier_type_id, pattern in get_identifier_patterns():
+        match = pattern.search(query)
+        if match is not None:
+            value = match.group(1) if match.groups() else match.group(0)
+            pairs.append((identifier_type_id, value))
+
+    return pairs
+
+
+def load_documents(entities):
+    """ Loads everything search_document needs for the provided entities,
+    including the data of each type, in a few queries however many entities
+    there are.
+    """
+
+    revisions = [entity.master_revision for entity in entities]
+    load_entity_data(revisions)
+
+    entity_data = [revision.entity_data for revision in revisions
+                   if revision is not None and
+                   revision.entity_data is not None]
+    if not entity_data:
+        return
+
+    load_data_relations(entity_data)
+
+    data_ids = set(data.entity_data_id for data in entity_data)
+    db.session.query(EntityData).options(*DOCUMENT_OPTIONS).\
+        filter(EntityData.entity_data_id.in_(data_ids)).all()
+
+
+def document_hits(hits):
+    """ Sets the source of each hit to the search document of its entity, as
+    it would be indexed, so that hits which don't come from Elasticsearch
+    have the same sources. Hits for deleted entities are dropped.
+    """
+
+    gids = [hit['_id'] for hit in hits['hits']]
+    if not gids:
+        return hits
+
+    entities = {
+        str(entity.entity_gid): entity for entity in
+        db.session.query(Entity).options(joinedload('master_revision')).
+        filter(Entity.entity_gid.in_(gids))
+    }
+    load_documents(entities.values())
+
+    documented = []
+    for hit in hits['hits']:
+        entity = entities.get(hit['_id'])
+        if entity is None or entity.master_revision is None or \
+                entity.master_revision.entity_data is None:
+            continue
+
+        hit['_source'] = search_document(
+            entity, entity.master_revision.entity_data
+        )
+        documented.append(hit)
+
+    hits['hits'] = documented
+    return hits
+
+
+def source_hits(hits, hydrate):
+    """ Sets the sources of hits which don't come from Elasticsearch to the
+    search documents of their entities. Hits to be hydrated are left without
+    sources, like those from Elasticsearch, and are hydrated by the caller.
+    """
+
+    if hydrate is None:
+        return document_hits(hits)
+
+    return hits
+
+
+def route_query(params):
+    """ Answers queries for entity UUIDs and identifiers directly from the
+    database, in the same format as Elasticsearch search hits, sorted by
+    entity GID. Returns None for free-text queries, and for identifier
+    queries which don't match any entities, which should be sent to
+    Elasticsearch.
+    """
+
+    query = params['q']
+    if is_uuid(query):
+        entities = [
+            entity for entity in db.session.query(Entity).
+            options(joinedload('master_revision')).
+            filter_by(entity_gid=query)
+            if entity.master_revision is not None and
+            entity.master_revision.entity_data_id is not None
+        ]
+    else:
+        pairs = detect_identifiers(query)
+        if not pairs:
+            return None
+
+        entities = []
+        for entity, _ in query_entities_by_identifiers(pairs).all():
+            if entity not in entities:
+                entities.append(entity)
+
+        # The query may be free text that looks like an identifier
+        if not entities:
+            return None
+
+    entities.sort(key=lambda entity: str(entity.entity_gid))
+
+    all_entities = entities
+    if params['collection'] is not None:
+        entities = [entity for entity in entities
+                    if type(entity).__name__.lower() == params['collection']]
+
+    total = len(entities)
+    if params['search_after'] is not None:
+        last_gid = params['search_after'][1]
+        entities = [entity for entity in entities
+                    if str(entity.entity_gid) > last_gid]
+
+    # One extra entity shows whether there is another page
+    page = entities[params['from']:params['from'] + params['size'] + 1]
+    hits = {
+        'total': total,
+        'max_score': None,
+        'hits': [{
+            '_id': str(entity.entity_gid),
+            '_type': type(entity).__name__.lower(),
+            '_score': None,
+            'sort': [0, str(entity.entity_gid)]
+        } for entity in page[:params['size']]],
+        'next_cursor': None
+    }
+
+    if hits['hits'] and len(page) > params['size']:
+        hits['next_cursor'] = encode_cursor(hits['hits'][-1]['sort'])
+
+    if 'type' in params['facets']:
+        hits['facets'] = {'type': count_types(
+            type(entity).__name__ for entity in all_entities
+        )}
+
+    return source_hits(hits, params['hydrate'])
+
+
+def search_cache_key(params):
+    """ Returns the Redis key under which the results for the provided search
+    parameters are cached. The key includes the current search generation of
+    the collection, so results are invalidated when anything in the collection
+    is indexed or deleted. Queries are compared case-insensitively.
+    """
+
+    # Searches of the shared alias, including type facets for a single
+    # collection, can change when anything is indexed.
+    if search_index(params) == index_alias():
+        collection = 'all'
+    else:
+        collection = params['collection']
+
+    generation = cache.get(SEARCH_GENERATION_KEY.format(collection)) or 0
+
+    normalized = params.copy()
+    normalized['q'] = normalized['q'].lower()
+    digest = hashlib.sha1(
+        json.dumps(normalized, sort_keys=True).encode('utf-8')
+    ).hexdigest()
+
+    return 'search:{}:{}:{}'.format(collection, generation, digest)
+
+
+def get_cached_hits(key):
+    """ Returns the cached search hits stored under key, or None if there
+    are none. Cache hits and misses are counted in the metrics.
+    """
+
+    if not current_app.config.get('SEARCH_CACHE_TIMEOUT', 300):
+        return None
+
+    cached = cache.get(key)
+    if cached is None:
+        count_metric('search_cache_misses')
+        return None
+
+    count_metric('search_cache_hits')
+    return json.loads(cached)
+
+
+def set_cached_hits(key, hits):
+    """ Caches search hits under key, for SEARCH_CACHE_TIMEOUT seconds. """
+
+    timeout = current_app.config.get('SEARCH_CACHE_TIMEOUT', 300)
+    if not timeout:
+        return
+
+    cache.set(key, json.dumps(hits))
+    cache.expire(key, timeout)
+
+
+class SearchBackend(object):
+    """ Defines the interface of search backends. Backends return hits in the
+    same format as Elasticsearch, and raise an ElasticsearchException if they
+    are unavailable. Hits are returned without sources if hydration was
+    requested, so that they can be cached before being hydrated.
+    """
+
+    name = None
+
+    def search(self, params):
+        raise NotImplementedError
+
+    def multi_search(self, all_params):
+        """ Returns the hits for each of the provided searches, in order.
+        Backends which can run several searches at once override this.
+        """
+        return [self.search(params) for params in all_params]
+
+
+class ElasticsearchBackend(SearchBackend):
+    name = 'elasticsearch'
+
+    def search(self, params):
+        results = es_breaker.call(
+            get_es_connection().search,
+            index=search_index(params),
+            body=build_query(params)
+        )
+
+        return self.format(results, params)
+
+    def multi_search(self, all_params):
+        body = []
+        for params in all_params:
+            body.append(build_header(params))
+            body.append(build_query(params))
+
+        results = es_breaker.call(get_es_connection().msearch, body=body)
+
+        responses = []
+        for params, result in zip(all_params, results['responses']):
+            if 'error' in result:
+                responses.append({'error': result['error']})
+            else:
+                responses.append(self.format(result, params))
+
+        return responses
+
+    @staticmethod
+    def format(results, params):
+        hits = format_hits(results['hits'], params)
+        if 'aggregations' in results:
+            hits['facets'] = format_facets(results['aggregations'])
+
+        return hits
+
+
+class PostgresBackend(SearchBackend):
+    """ Searches the alias names of the master revisions of entities in the
+    database. Autocomplete searches are prefix matches, and other searches
+    use pg_trgm similarity, both of which can use the indexes created by
+    config/search-fallback.sql. Hits are sorted in SORT_ORDER, so pages can
+    be requested with "from" or search_after.
+    """
+
+    name = 'postgres'
+
+    def search(self, params):
+        query = params['q']
+
+        # Scores are double precision, so that they survive being encoded in
+        # cursors and compared again exactly.
+        score = cast(func.max(func.similarity(Alias.name, query)), Float)
+
+        matches = db.session.query(
+            Entity.entity_gid, Entity._type.label('entity_type'),
+            score.label('score')
+        ).join(EntityRevision, Entity.master_revision).\
+            join(EntityData, EntityRevision.entity_data).\
+            join(Alias, EntityData.aliases)
+
+        if params['mode'] == 'auto':
+            prefix = query.lower().replace('\\', '\\\\').\
+                replace('%', '\\%').replace('_', '\\_')
+            matches = matches.filter(
+                func.lower(Alias.name).like(prefix + u'%')
+            )
+        else:
+            # The pg_trgm similarity operator
+            matches = matches.filter(Alias.name.op('%')(query))
+
+        matches = matches.group_by(Entity.entity_gid, Entity._type)
+
+        facets = None
+        if 'type' in params['facets']:
+            # Only type facets are supported, counted across all collections
+            counted = matches.subquery()
+            type_counts = db.session.query(
+                counted.c.entity_type, func.count()
+            ).group_by(counted.c.entity_type).all()
+            facets = {'type': [
+                {'value': entity_type.lower(), 'count': count}
+                for entity_type, count in
+                sorted(type_counts, key=lambda row: (-row[1], row[0]))
+            ]}
+
+        if params['collection'] is not None:
+            matches = matches.filter(
+                Entity._type == params['collection'].capitalize()
+            )
+
+        total = matches.count()
+
+        if params['search_after'] is not None:
+            last_score, last_gid = params['search_after']
+            matches = matches.having(or_(
+                score < last_score,
+                and_(score == last_score, Entity.entity_gid > last_gid)
+            ))
+
+        # One extra row shows whether there is another page
+        rows = matches.order_by(desc('score'), Entity.entity_gid).\
+            offset(params['from']).limit(params['size'] + 1).all()
+
+        hits = {
+            'total': total,
+            'max_score': rows[0].score if rows else None,
+            'hits': [{
+                '_id': str(row.entity_gid),
+                '_type': row.entity_type.lower(),
+                '_score': row.score,
+                'sort': [row.score, str(row.entity_gid)]
+            } for row in rows[:params['size']]],
+            'next_cursor': None
+        }
+
+        if hits['hits'] and len(rows) > params['size']:
+            hits['next_cursor'] = encode_cursor(hits['hits'][-1]['sort'])
+
+        if facets is not None:
+            hits['facets'] = facets
+
+        return source_hits(hits, params['hydrate'])
+
+
+BACKENDS = {
+    backend.name: backend
+    for backend in [ElasticsearchBackend(), PostgresBackend()]
+}
+
+
+def run_with_fallback(method, argument):
+    """ Calls the named method of the backend selected by SEARCH_BACKEND. If
+    the backend is unavailable, the SEARCH_FALLBACK backend is used instead.
+    Returns the result, and whether it came from the fallback backend. Aborts
+    with 503 if there is no fallback, or with 400 if the backend rejected the
+    request.
+    """
+
+    backend = BACKENDS[current_app.config.get('SEARCH_BACKEND',
+                                              'elasticsearch')]
+    try:
+        return getattr(backend, method)(argument), False
+    except ElasticsearchException as exc:
+        if not is_unavailable(exc):
+            if isinstance(exc, TransportError):
+                abort(400)
+            raise
+
+        fallback = current_app.config.get('SEARCH_FALLBACK', 'postgres')
+        if not fallback or fallback == backend.name:
+            abort(503)
+
+    count_metric('search_fallbacks')
+    return getattr(BACKENDS[fallback], method)(argument), True
+
+
+def run_search(params):
+    """ Runs a single search on the configured search backend. Results from
+    the fallback backend are marked as degraded.
+    """
+
+    hits, degraded = run_with_fallback('search', params)
+    if degraded:
+        hits['degraded'] = True
+
+    return hits
+
+
+def run_multi_search(all_params):
+    """ Runs several searches on the configured search backend, returning
+    the hits for each search in order. Results from the fallback backend are
+    marked as degraded.
+    """
+
+    responses, degraded = run_with_fallback('multi_search', all_params)
+    if degraded:
+        for hits in responses:
+            hits['degraded'] = True
+
+    return responses
+
+
+def iter_entities(*criteria, **kwargs):
+    """ Yields every entity matching criteria, along with everything
+    search_document needs. Entities are loaded in chunks, ordered by GID.
+    """
+
+    chunk_size = kwargs.get('chunk_size', 500)
+
+    last_gid = None
+    while True:
+        query = db.session.query(Entity).\
+            options(joinedload('master_revision'))
+        query = query.filter(*criteria)
+        if last_gid is not None:
+            query = query.filter(Entity.entity_gid > last_gid)
+
+        chunk = query.order_by(Entity.entity_gid).limit(chunk_size).all()
+        if not chunk:
+            return
+
+        load_documents(chunk)
+
+        for entity in chunk:
+            yield entity
+
+        last_gid = chunk[-1].entity_gid
+
+
+def index_actions(entities, index_name=None, delete_missing=False):
+    """ Generates bulk index actions for the documents of entities. Documents
+    are sent to index_name if it is provided, or otherwise to the alias for
+    their type. Entities without data, which have been deleted, are skipped,
+    or removed from the alias for their type if delete_missing is True.
+    """
+
+    for entity in entities:
+        revision = entity.master_revision
+        if revision is None or revision.entity_data is None:
+            if delete_missing:
+                doc_type = entity._type.lower()
+                yield {
+                    '_op_type': 'delete',
+                    '_index': index_alias(doc_type),
+                    '_type': doc_type,
+                    '_id': str(entity.entity_gid)
+                }
+            continue
+
+        document = search_document(entity, revision.entity_data)
+        doc_type = document['type'].lower()
+        yield {
+            '_index': index_name or index_alias(doc_type),
+            '_type': doc_type,
+            '_id': document['entity_gid'],
+            '_source': document
+        }
+
+
+def install_template(es_conn):
+    """ Installs the index template from config/search-template.json, which
+    defines the analyzers and mappings of the search indices, unless the same
+    or a newer version of it is already installed.
+    """
+
+    with open(current_app.config.get('SEARCH_TEMPLATE',
+                                     TEMPLATE_FILE)) as template_file:
+        template = json.load(template_file)
+
+    if es_conn.indices.exists_template(name=INDEX_ALIAS):
+        installed = es_conn.indices.get_template(name=INDEX_ALIAS)
+        version = installed[INDEX_ALIAS].get('version')
+        if version is not None and version >= template['version']:
+            return
+
+    es_conn.indices.put_template(name=INDEX_ALIAS, body=template)
+
+
+def new_index_name(collection):
+    """ Returns the name of a new versioned index for collection. Versions
+    include microseconds, so that reindexes don't reuse each other's names.
+    """
+
+    return '{}_v{}'.format(index_alias(collection),
+                           datetime.utcnow().strftime('%Y%m%d%H%M%S%f'))
+
+
+def build_index(es_conn, collection, index_name, timeout):
+    """ Creates the index named index_name for collection and loads the
+    search documents of all its entities into it. While the index is loaded,
+    refreshing is disabled and it has no replicas.
+    """
+
+    settings = {
+        'refresh_interval': '-1',
+        'number_of_replicas': 0
+    }
+
+    shards = current_app.config.get('SEARCH_SHARDS', {}).get(collection)
+    if shards is not None:
+        settings['number_of_shards'] = shards
+
+    # Analysis settings and mappings come from the template
+    es_conn.indices.create(index=index_name, body={
+        'settings': {'index': settings}
+    }, request_timeout=timeout)
+
+    entities = iter_entities(Entity._type == collection.capitalize())
+    helpers.bulk(es_conn, index_actions(entities, index_name),
+                 chunk_size=500, request_timeout=timeout)
+
+    es_conn.indices.put_settings(index=index_name, body={
+        'index': {
+            'refresh_interval': current_app.config.get(
+                'SEARCH_REFRESH_INTERVAL', '1s'
+            ),
+            'number_of_replicas': current_app.config.get(
+                'SEARCH_REPLICAS', 1
+            )
+        }
+    }, request_timeout=timeout)
+    es_conn.indices.refresh(index=index_name, request_timeout=timeout)
+
+
+def alias_swap_actions(es_conn, index_names):
+    """ Returns the actions which point the shared search alias and the alias
+    for each type at the provided new indices, and the names of the indices
+    they replace. Concrete indices with the name of an alias, which are
+    created when documents are indexed before the first reindex, are deleted
+    by the same actions that give their names to the aliases.
+    """
+
+    actions = []
+    old_indices = set()
+    for collection in [None] + COLLECTIONS:
+        alias = index_alias(collection)
+        if es_conn.indices.exists_alias(name=alias):
+            for old_index in es_conn.indices.get_alias(name=alias):
+                old_indices.add(old_index)
+                actions.append(
+                    {'remove': {'index': old_index, 'alias': alias}}
+                )
+        elif es_conn.indices.exists(index=alias):
+            actions.append({'remove_index': {'index': alias}})
+
+    for collection, index_name in zip(COLLECTIONS, index_names):
+        actions.append({'add': {'index': index_name, 'alias': INDEX_ALIAS}})
+        actions.append({'add': {
+            'index': index_name, 'alias': index_alias(collection)
+        }})
+
+    return actions, sorted(old_indices)
+
+
+def reindex():
+    """ Builds a new versioned index for each entity type, using the
+    installed index template. Then it atomically points the alias for each
+    type, and the shared search alias, at the new indices, and deletes the
+    indices they replace. If anything fails before the swap, the new indices
+    are deleted. Entities updated during the build are indexed again after
+    the swap. Returns the names of the new indices.
+    """
+
+    es_conn = get_es_connection()
+    timeout = current_app.config.get('ELASTICSEARCH_REINDEX_TIMEOUT', 120)
+    # Entity.last_updated is stored in UTC, without a time zone
+    started_at = db.session.query(func.timezone('UTC', func.now())).scalar()
+
+    install_template(es_conn)
+
+    index_names = [new_index_name(collection) for collection in COLLECTIONS]
+
+    swapped = False
+    try:
+        for collection, index_name in zip(COLLECTIONS, index_names):
+            build_index(es_conn, collection, index_name, timeout)
+
+        # Swap the aliases to the new indices in a single atomic action
+        actions, old_indices = alias_swap_actions(es_conn, index_names)
+        es_conn.indices.update_aliases(body={'actions': actions},
+                                       request_timeout=timeout)
+        swapped = True
+    finally:
+        if not swapped:
+            # Some of the new indices may not have been created
+            es_conn.indices.delete(index=','.join(index_names),
+                                   ignore_unavailable=True, ignore=404,
+                                   request_timeout=timeout)
+
+    for old_index in old_indices:
+        es_conn.indices.delete(index=old_index, request_timeout=timeout)
+
+    # Catch up with any writes made to the old indices during the build.
+    # Entities deleted during the build may not have been indexed at all.
+    updated = iter_entities(Entity.last_updated >= started_at)
+    _, errors = helpers.bulk(es_conn,
+                             index_actions(updated, delete_missing=True),
+                             raise_on_error=False, request_timeout=timeout)
+    errors = [error for error in errors
+              if error.get('delete', {}).get('status') != 404]
+    if errors:
+        raise helpers.BulkIndexError(
+            '{} document(s) failed to index.'.format(len(errors)), errors
+        )
+
+    for collection in COLLECTIONS + ['all']:
+        cache.incr(SEARCH_GENERATION_KEY.format(collection))
+
+    return index_names
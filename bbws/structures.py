@@ -149,12 +149,14 @@ RELATIONSHIP_REVISION.update({
 REVISION_LIST = {
     'offset': fields.Integer,
     'count': fields.Integer,
+    'next_cursor': fields.String(default=None),
     'objects': fields.List(fields.Nested(REVISION_STUB))
 }
 
 ENTITY_REVISION_LIST = {
     'offset': fields.Integer,
     'count': fields.Integer,
+    'next_cursor': fields.String(default=None),
     'objects': fields.List(fields.Nested(ENTITY_REVISION))
 }
 
@@ -202,6 +204,23 @@ ENTITY_STUB = {
     '_type': fields.String
 }
 
+IDENTIFIER_VALUE = {
+    'identifier_type_id': fields.Integer,
+    'value': fields.String
+}
+
+IDENTIFIER_LOOKUP = IDENTIFIER_VALUE.copy()
+IDENTIFIER_LOOKUP.update({
+    'entities': fields.List(fields.Nested(ENTITY_STUB))
+})
+
+IDENTIFIER_LOOKUP_LIST = {
+    'offset': fields.Integer,
+    'count': fields.Integer,
+    'objects': fields.List(fields.Nested(IDENTIFIER_LOOKUP)),
+    'unknown': fields.List(fields.Nested(IDENTIFIER_VALUE))
+}
+
 ENTITY = ENTITY_STUB.copy()
 ENTITY.update({
     'last_updated': fields.DateTime(dt_format='iso8601'),
@@ -308,6 +327,18 @@ RELATIONSHIP.update({
     }), attribute='master_revision.relationship_data.texts')
 })
 
+RELATIONSHIP_DATA = {
+    'relationship_type': fields.Nested(RELATIONSHIP_TYPE, allow_null=True),
+    'entities': fields.List(fields.Nested({
+        'entity': fields.Nested(ENTITY_STUB),
+        'position': fields.Integer
+    })),
+    'texts': fields.List(fields.Nested({
+        'text': fields.String,
+        'position': fields.Integer
+    }))
+}
+
 RELATIONSHIP_DIFF = {
     'relationship_type':
         fields.List(fields.Nested(RELATIONSHIP_TYPE, allow_null=True)),
@@ -24,6 +24,7 @@ from flask_restful import Resource, abort, marshal, reqparse
 from sqlalchemy.orm.exc import NoResultFound
 from . import structures
 from .services import db, oauth_provider
+from .util import retry_transaction
 
 
 class UserResource(Resource):
@@ -54,6 +55,7 @@ class UserResource(Resource):
         return marshal(user, structures.USER)
 
     @oauth_provider.require_oauth()
+    @retry_transaction
     def put(self, user_id):
         """ Update information about a single User of the webservice. Currently
         only allows updating the user bio. Requires authentication. For response
@@ -147,6 +149,7 @@ class UserResourceList(Resource):
             'objects': users
         }, structures.USER_LIST)
 
+    @retry_transaction
     def post(self):
         json = request.get_json()
 
@@ -269,6 +272,7 @@ class UserMessageSentResource(Resource):
     post_parser.add_argument('content', type=unicode, required=True)
 
     @oauth_provider.require_oauth()
+    @retry_transaction
     def post(self):
         """ Add a new message to the sent messages list, to the recipients
         indicated in the POST body.
@@ -17,7 +17,37 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import base64
+import binascii
+import json
+import random
+import threading
+import time
 import uuid
+from functools import wraps
+
+from elasticsearch import (ConnectionError, Elasticsearch,
+                           ElasticsearchException, NotFoundError,
+                           TransportError)
+from flask import current_app, request
+from sqlalchemy.exc import OperationalError
+
+from .services import cache, db
+
+
+METRICS_KEY = 'metrics'
+
+# Each entity type has its own versioned index, built by the reindex
+# endpoint, behind an alias named by index_alias. This alias points at the
+# indices of every type.
+INDEX_ALIAS = 'bookbrainz'
+
+# Search results cached for a collection are only valid for the generation
+# stored under this key, which is bumped whenever the collection is indexed.
+SEARCH_GENERATION_KEY = 'search_generation:{}'
+
+# PostgreSQL error codes for serialization_failure and deadlock_detected
+RETRYABLE_PGCODES = ('40001', '40P01')
 
 
 def is_uuid(test_str):
@@ -32,15 +62,271 @@ def is_uuid(test_str):
         return True
 
 
-def index_entity(es_conn, entity):
-    """ Index an entity in the provided elasticsearch connection. """
-    es_conn.index(
-        index='bookbrainz',
-        doc_type=entity['_type'].lower(),
-        id=entity['entity_gid'],
-        body=entity
+def encode_cursor(values):
+    """ Encodes a list of JSON-serializable values (such as the sort values of
+    the last item in a page of results) as an opaque, URL-safe cursor.
+    """
+    return base64.urlsafe_b64encode(json.dumps(values))
+
+
+def decode_cursor(cursor):
+    """ Decodes a cursor produced by encode_cursor, returning the list of
+    values, or None if the cursor is malformed.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (binascii.Error, TypeError, ValueError):
+        return None
+
+    if not isinstance(values, list):
+        return None
+
+    return values
+
+
+class CircuitOpenError(ElasticsearchException):
+    """ Raised in place of calling a service while its circuit breaker is
+    open. Inherits from ElasticsearchException, so that code which tolerates
+    Elasticsearch failures also skips calls while the breaker is open.
+    """
+
+
+def is_unavailable(exc):
+    """ Tests whether an Elasticsearch exception means that the service is
+    unavailable, rather than that it rejected the request. Connection errors,
+    errors with a 5xx status and open breakers count as unavailable.
+    """
+    if isinstance(exc, (ConnectionError, CircuitOpenError)):
+        return True
+
+    if isinstance(exc, TransportError):
+        status = exc.status_code
+        return not isinstance(status, int) or status >= 500
+
+    return False
+
+
+class CircuitBreaker(object):
+    """ Stops calls to a service after repeated failures, shared by all of the
+    requests handled by this process. After ELASTICSEARCH_BREAKER_THRESHOLD
+    consecutive failures, the breaker opens and calls fail immediately with a
+    CircuitOpenError. Once ELASTICSEARCH_BREAKER_RESET seconds have passed, a
+    single trial call is let through, which closes the breaker if it succeeds.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def call(self, func, *args, **kwargs):
+        threshold = current_app.config.get('ELASTICSEARCH_BREAKER_THRESHOLD',
+                                           5)
+        reset = current_app.config.get('ELASTICSEARCH_BREAKER_RESET', 30)
+
+        with self.lock:
+            if self.opened_at is not None:
+                if time.time() - self.opened_at < reset:
+                    count_metric('{}_breaker_rejections'.format(self.name))
+                    raise CircuitOpenError('{} circuit breaker is open'
+                                           .format(self.name))
+
+                # Let this call through as a trial, but keep rejecting other
+                # calls until it has finished
+                self.opened_at = time.time()
+
+        try:
+            result = func(*args, **kwargs)
+        except TransportError as exc:
+            if is_unavailable(exc):
+                self.record_failure(threshold)
+            else:
+                # The service answered, even though it rejected the request
+                self.record_success()
+            raise
+
+        self.record_success()
+        return result
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self, threshold):
+        with self.lock:
+            self.failures += 1
+            count_metric('{}_failures'.format(self.name))
+
+            if self.failures >= threshold:
+                if self.opened_at is None:
+                    count_metric('{}_breaker_opened'.format(self.name))
+                self.opened_at = time.time()
+
+
+es_breaker = CircuitBreaker('elasticsearch')
+
+
+def get_es_connection():
+    """ Returns the Elasticsearch client for the current application, which
+    is created on first use and shared between requests. Calls time out after
+    ELASTICSEARCH_TIMEOUT seconds.
+    """
+    es_conn = current_app.extensions.get('elasticsearch')
+    if es_conn is None:
+        es_conn = Elasticsearch(
+            timeout=current_app.config.get('ELASTICSEARCH_TIMEOUT', 2),
+            max_retries=current_app.config.get('ELASTICSEARCH_MAX_RETRIES', 0)
+        )
+        current_app.extensions['elasticsearch'] = es_conn
+
+    return es_conn
+
+
+def search_document(entity, entity_data):
+    """ Builds the document indexed for an entity, which only contains the
+    fields that are searched on or needed to display a search result.
+    """
+    default_alias = entity_data.default_alias
+    disambiguation = entity_data.disambiguation
+
+    # Editions have one language, and works can have several
+    languages = getattr(entity_data, 'languages', None) or []
+    if getattr(entity_data, 'language', None) is not None:
+        languages = [entity_data.language]
+
+    edition_format = getattr(entity_data, 'edition_format', None)
+
+    if default_alias is None:
+        default_alias_doc = None
+    else:
+        default_alias_doc = {
+            'name': default_alias.name,
+            'sort_name': default_alias.sort_name
+        }
+
+    return {
+        'entity_gid': str(entity.entity_gid),
+        'type': entity._type,
+        'default_alias': default_alias_doc,
+        'aliases': [{'name': alias.name} for alias in entity_data.aliases],
+        'disambiguation': (None if disambiguation is None
+                           else disambiguation.comment),
+        'languages': [language.name for language in languages],
+        'edition_format': (None if edition_format is None
+                           else edition_format.label)
+    }
+
+
+def index_alias(collection=None):
+    """ Returns the alias of the search index for collection, or of all
+    search indices if collection is None.
+    """
+    if collection is None:
+        return INDEX_ALIAS
+
+    return '{}_{}'.format(INDEX_ALIAS, collection)
+
+
+def index_entity(es_conn, document):
+    """ Index an entity document, built by search_document, in the provided
+    elasticsearch connection, and invalidate any cached search results which
+    could include it. Cached results are only invalidated once the document
+    is searchable, so that searches in between can't cache the old results
+    again.
+    """
+    doc_type = document['type'].lower()
+
+    es_breaker.call(
+        es_conn.index,
+        index=index_alias(doc_type),
+        doc_type=doc_type,
+        id=document['entity_gid'],
+        body=document,
+        refresh='wait_for'
     )
 
+    bump_search_generation(doc_type)
+
+
+def unindex_entity(es_conn, entity):
+    """ Remove a deleted entity from the provided elasticsearch connection,
+    and invalidate any cached search results which could include it. As for
+    index_entity, this waits until the removal is searchable. Cached results
+    are invalidated even if the entity can't be removed.
+    """
+    doc_type = entity._type.lower()
+
+    try:
+        es_breaker.call(
+            es_conn.delete,
+            index=index_alias(doc_type),
+            doc_type=doc_type,
+            id=str(entity.entity_gid),
+            refresh='wait_for'
+        )
+    except NotFoundError:
+        pass
+    finally:
+        bump_search_generation(doc_type)
+
+
+def bump_search_generation(collection):
+    """ Invalidates the cached search results for collection, and for
+    searches across all collections.
+    """
+    cache.incr(SEARCH_GENERATION_KEY.format(collection))
+    cache.incr(SEARCH_GENERATION_KEY.format('all'))
+
+
+def count_metric(name, amount=1):
+    """ Increments the named counter in the metrics hash stored in Redis. All
+    counters are reported by the /metrics endpoint.
+    """
+    cache.hincrby(METRICS_KEY, name, amount)
+
+
+def retry_transaction(func):
+    """ Decorator for write handlers, which re-runs the whole handler if the
+    database aborts the transaction because of a serialization failure or a
+    deadlock. The session is rolled back before each retry, and retries are
+    spaced with jittered exponential backoff. The number of retries and the
+    base delay are taken from the TRANSACTION_RETRIES and
+    TRANSACTION_RETRY_DELAY config values.
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        retries = current_app.config.get('TRANSACTION_RETRIES', 3)
+        delay = current_app.config.get('TRANSACTION_RETRY_DELAY', 0.05)
+
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as exc:
+                db.session.rollback()
+
+                pgcode = getattr(exc.orig, 'pgcode', None)
+                if pgcode not in RETRYABLE_PGCODES:
+                    raise
+
+                if attempt >= retries:
+                    count_metric('transaction_retry_failures')
+                    raise
+
+                count_metric('transaction_retries')
+                count_metric('transaction_retries:{}'.format(request.endpoint))
+                time.sleep(random.uniform(0, delay * 2 ** attempt))
+                attempt += 1
+
+    return wrapper
+
 
 def add_cors_header(response):
     """ Adds CORS headers to responses, so that cross-domain requests are
@@ -0,0 +1,12 @@
+-- Indexes used by the PostgreSQL search backend (SEARCH_BACKEND = 'postgres'
+-- or SEARCH_FALLBACK = 'postgres'). Run once against the BookBrainz database.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- Trigram similarity searches on alias names
+CREATE INDEX alias_name_trgm_idx
+    ON bookbrainz.alias USING gin (name gin_trgm_ops);
+
+-- Prefix matches for autocomplete searches
+CREATE INDEX alias_name_lower_prefix_idx
+    ON bookbrainz.alias (lower(name) text_pattern_ops);
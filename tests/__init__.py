@@ -24,3 +24,9 @@ from test_publication import *
 from test_publisher import *
 from test_edition import *
 from test_display_alias import *
+from test_entity_revisions import *
+from test_identifier_lookup import *
+from test_revision import *
+from test_util import *
+from test_search import *
+from test_autocomplete import *
@@ -0,0 +1,48 @@
+# -*- coding: utf8 -*-
+
+# Copyright (C) 2016  Ben Ockmore
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+    This module contains a helper for checking how many queries are made to
+    the database, so that tests can check queries are made in bulk
+"""
+
+from sqlalchemy import event
+
+from bbws import db
+
+
+def count_queries(function, *args, **kwargs):
+    """ Calls function with the provided arguments and an empty session, so
+    that nothing is already loaded. Returns its result and the number of
+    queries made while it ran.
+    """
+    db.session.remove()
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        result = function(*args, **kwargs)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+
+    return result, len(statements)
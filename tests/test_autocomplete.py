@@ -0,0 +1,156 @@
+# -*- coding: utf8 -*-
+
+# Copyright (C) 2016  Ben Ockmore
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import json
+
+from bbschema import Alias, Creator, Entity, Work, create_all
+from flask_testing import TestCase
+from sqlalchemy import func
+from werkzeug.test import Headers
+
+from bbws import create_app, db
+from bbws.autocomplete import AutocompleteIndex, normalize_name
+from .fixture import load_data
+
+
+class TestAutocomplete(TestCase):
+    """ Tests for the in-process autocomplete index. """
+    def create_app(self):
+        return create_app('../config/test.py')
+
+    # noinspection PyPep8Naming
+    def setUp(self):
+        db.engine.execute("DROP SCHEMA IF EXISTS bookbrainz CASCADE")
+        db.engine.execute("CREATE SCHEMA bookbrainz")
+        create_all(db.engine)
+        load_data(db)
+
+        self.creator = db.session.query(Creator).\
+            order_by(Creator.entity_gid).first()
+        self.work = db.session.query(Work).order_by(Work.entity_gid).first()
+        self.set_name(self.creator, u'Zébédée Quux')
+        self.set_name(self.work, u'Zebra Stories')
+
+        self.index = AutocompleteIndex()
+
+        response = self.client.post(
+            '/oauth/token',
+            data={
+                'client_id': '9ab9da7e-a7a3-4f86-87c6-bf8b4b8213c7',
+                'username': 'Bob',
+                'password': "bb",
+                'grant_type': 'password'
+            })
+
+        self.assert200(response)
+        self.headers = Headers(
+            [('Authorization',
+              'Bearer ' + response.json.get(u'access_token')),
+             ('Content-Type', 'application/json')])
+
+    # noinspection PyPep8Naming
+    def tearDown(self):
+        db.session.remove()
+        db.engine.execute("DROP SCHEMA IF EXISTS bookbrainz CASCADE")
+
+    def set_name(self, entity, name):
+        """ Gives entity a new default alias, and marks it as updated. """
+        alias = Alias(name=name, sort_name=name, primary=True)
+        entity_data = entity.master_revision.entity_data
+        entity_data.aliases.append(alias)
+        entity_data.default_alias = alias
+        db.session.query(Entity).filter_by(entity_gid=entity.entity_gid).\
+            update({'last_updated': func.timezone('UTC', func.now())},
+                   synchronize_session=False)
+        db.session.commit()
+
+    def search(self, q, collection=None, size=10):
+        hits = self.index.search({
+            'q': q, 'collection': collection, 'from': 0, 'size': size
+        })
+        return [hit['_id'] for hit in hits['hits']]
+
+    def test_normalize_name(self):
+        self.assertEquals(normalize_name(u'  Zébédée   QUUX '),
+                          u'zebedee quux')
+
+    def test_search(self):
+        self.index.build()
+        self.assertTrue(self.index.ready)
+
+        self.assertEquals(self.search(u'zebe'),
+                          [str(self.creator.entity_gid)])
+        self.assertEquals(
+            sorted(self.search(u'ZEB')),
+            sorted([str(self.creator.entity_gid), str(self.work.entity_gid)])
+        )
+        self.assertEquals(self.search(u'zeb', collection='work'),
+                          [str(self.work.entity_gid)])
+        self.assertEquals(self.search(u'zeb', collection='edition'), [])
+        self.assertEquals(len(self.search(u'zeb', size=1)), 1)
+
+    def test_refresh(self):
+        self.index.build()
+
+        self.set_name(self.creator, u'Quentin Zebulon')
+        self.index.refresh(0, 60)
+
+        self.assertEquals(self.search(u'zeb'), [str(self.work.entity_gid)])
+        self.assertEquals(self.search(u'quentin', collection='creator'),
+                          [str(self.creator.entity_gid)])
+
+    def test_refresh_after_patch(self):
+        self.index.build()
+
+        # Only entities updated since the build are checked with no overlap,
+        # so the creator only comes back if the PATCH marked it as updated
+        self.index.remove(str(self.creator.entity_gid))
+        self.assertEquals(self.search(u'zebe'), [])
+
+        response = self.client.patch(
+            '/creator/{}/'.format(self.creator.entity_gid),
+            headers=self.headers,
+            data=json.dumps({'disambiguation': u'The other one'})
+        )
+        self.assert200(response)
+
+        self.index.refresh(0, 0)
+        self.assertEquals(self.search(u'zebe'),
+                          [str(self.creator.entity_gid)])
+
+    def test_refresh_after_delete(self):
+        self.index.build()
+
+        response = self.client.delete(
+            '/creator/{}/'.format(self.creator.entity_gid),
+            headers=self.headers,
+            data=json.dumps({'revision': {'note': u'A Test Note'}})
+        )
+        self.assert200(response)
+
+        self.index.refresh(0, 0)
+        self.assertEquals(self.search(u'zebe'), [])
+
+    def test_refresh_interval(self):
+        self.index.build()
+
+        self.set_name(self.creator, u'Quentin Zebulon')
+        self.index.refresh(60, 60)
+
+        # Refreshes are skipped until the interval has passed
+        self.assertEquals(self.search(u'quentin'), [])
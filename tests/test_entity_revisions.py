@@ -0,0 +1,327 @@
+# -*- coding: utf8 -*-
+
+# Copyright (C) 2016  Ben Ockmore
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import json
+
+from bbschema import Creator, EntityData, create_all
+from flask_testing import TestCase
+from werkzeug.test import Headers
+
+from bbws import create_app, db
+from .fixture import load_data
+from .query_counting import count_queries
+
+
+class TestEntityRevisions(TestCase):
+    """ Tests for the requests which create or read particular revisions of
+    an entity, other than plain PUT and POST.
+    """
+    def create_app(self):
+        return create_app('../config/test.py')
+
+    # noinspection PyPep8Naming
+    def setUp(self):
+        db.engine.execute("DROP SCHEMA IF EXISTS bookbrainz CASCADE")
+        db.engine.execute("CREATE SCHEMA bookbrainz")
+        create_all(db.engine)
+        load_data(db)
+
+        response = self.client.post(
+            '/oauth/token',
+            data={
+                'client_id': '9ab9da7e-a7a3-4f86-87c6-bf8b4b8213c7',
+                'username': 'Bob',
+                'password': "bb",
+                'grant_type': 'password'
+            })
+
+        self.assert200(response)
+        self.headers = Headers(
+            [('Authorization',
+              'Bearer ' + response.json.get(u'access_token')),
+             ('Content-Type', 'application/json')])
+
+    # noinspection PyPep8Naming
+    def tearDown(self):
+        db.session.remove()
+        db.engine.execute("DROP SCHEMA IF EXISTS bookbrainz CASCADE")
+
+    def get_creator(self):
+        return db.session.query(Creator).\
+            order_by(Creator.entity_gid).first()
+
+    def test_patch_single_field(self):
+        creator = self.get_creator()
+        entity_gid = creator.entity_gid
+        old_revision_id = creator.master_revision_id
+        old_data = creator.master_revision.entity_data
+        old_begin_date = old_data.begin_date
+        ended = not old_data.ended
+
+        response = self.client.patch(
+            '/creator/{}/'.format(entity_gid),
+            headers=self.headers,
+            data=json.dumps({'ended': ended})
+        )
+        self.assert200(response)
+
+        db.session.expire_all()
+        creator = db.session.query(Creator).\
+            filter_by(entity_gid=entity_gid).one()
+        self.assertNotEquals(creator.master_revision_id, old_revision_id)
+
+        new_data = creator.master_revision.entity_data
+        self.assertEquals(new_data.ended, ended)
+        self.assertEquals(new_data.begin_date, old_begin_date)
+
+    def test_patch_empty(self):
+        creator = self.get_creator()
+        old_revision_id = creator.master_revision_id
+
+        response = self.client.patch(
+            '/creator/{}/'.format(creator.entity_gid),
+            headers=self.headers,
+            data=json.dumps({})
+        )
+        self.assert200(response)
+
+        db.session.expire_all()
+        creator = self.get_creator()
+        self.assertEquals(creator.master_revision_id, old_revision_id)
+
+    def test_patch_bad_document(self):
+        creator = self.get_creator()
+
+        response = self.client.patch(
+            '/creator/{}/'.format(creator.entity_gid),
+            headers=self.headers,
+            data=json.dumps([{'op': 'replace', 'path': '/ended'}])
+        )
+        self.assert400(response)
+
+    def test_revert(self):
+        creator = self.get_creator()
+        entity_gid = creator.entity_gid
+        original = creator.master_revision
+        original_revision_id = original.revision_id
+        original_data_id = original.entity_data_id
+
+        response = self.client.patch(
+            '/creator/{}/'.format(entity_gid),
+            headers=self.headers,
+            data=json.dumps({'ended': not original.entity_data.ended})
+        )
+        self.assert200(response)
+
+        data_count = db.session.query(EntityData).count()
+
+        response = self.client.post(
+            '/creator/{}/revert'.format(entity_gid),
+            headers=self.headers,
+            data=json.dumps({'revision_id': original_revision_id,
+                             'revision': {'note': u'Revert vandalism'}})
+        )
+        self.assert200(response)
+
+        db.session.expire_all()
+        creator = db.session.query(Creator).\
+            filter_by(entity_gid=entity_gid).one()
+        self.assertNotEquals(creator.master_revision_id, original_revision_id)
+        self.assertEquals(creator.master_revision.entity_data_id,
+                          original_data_id)
+        self.assertEquals(db.session.query(EntityData).count(), data_count)
+
+    def test_revert_to_current(self):
+        creator = self.get_creator()
+
+        response = self.client.post(
+            '/creator/{}/revert'.format(creator.entity_gid),
+            headers=self.headers,
+            data=json.dumps({'revision_id': creator.master_revision_id})
+        )
+        self.assert400(response)
+
+    def test_revert_bad_revision(self):
+        creator = self.get_creator()
+
+        response = self.client.post(
+            '/creator/{}/revert'.format(creator.entity_gid),
+            headers=self.headers,
+            data=json.dumps({'revision_id': 999999})
+        )
+        self.assert404(response)
+
+    def test_revert_bad_body(self):
+        creator = self.get_creator()
+
+        for body in ['', 'not json', json.dumps([1]), json.dumps({}),
+                     json.dumps({'revision_id': '1'}),
+                     json.dumps({'revision_id': True}),
+                     json.dumps({'revision_id': creator.master_revision_id,
+                                 'revision': 'note'})]:
+            response = self.client.post(
+                '/creator/{}/revert'.format(creator.entity_gid),
+                headers=self.headers,
+                data=body
+            )
+            self.assert400(response)
+
+    def test_get_at(self):
+        creator = self.get_creator()
+        entity_gid = creator.entity_gid
+        original_revision_id = creator.master_revision_id
+        created_at = creator.master_revision.created_at
+
+        response = self.client.patch(
+            '/creator/{}/'.format(entity_gid),
+            headers=self.headers,
+            data=json.dumps({
+                'ended': not creator.master_revision.entity_data.ended
+            })
+        )
+        self.assert200(response)
+
+        response = self.client.get(
+            '/creator/{}/'.format(entity_gid),
+            query_string={'at': created_at.isoformat()}
+        )
+        self.assert200(response)
+        self.assertEquals(response.json[u'revision'][u'revision_id'],
+                          original_revision_id)
+
+        response = self.client.get(
+            '/creator/{}/'.format(entity_gid),
+            query_string={'at': '1900-01-01T00:00:00'}
+        )
+        self.assert404(response)
+
+    def test_get_at_sub_resources(self):
+        entity_gid = self.get_creator().entity_gid
+
+        for sub_resource in ['aliases', 'disambiguation', 'annotation',
+                             'identifiers']:
+            response = self.client.get(
+                '/creator/{}/{}'.format(entity_gid, sub_resource),
+                query_string={'at': '1900-01-01T00:00:00'}
+            )
+            self.assert404(response)
+
+            response = self.client.get(
+                '/creator/{}/{}'.format(
+                    '00000000-0000-0000-0000-000000000000', sub_resource
+                ),
+                query_string={'at': '2100-01-01T00:00:00'}
+            )
+            self.assert404(response)
+
+    def test_get_since_revision(self):
+        creator = self.get_creator()
+        entity_gid = creator.entity_gid
+        original_revision_id = creator.master_revision_id
+
+        response = self.client.patch(
+            '/creator/{}/'.format(entity_gid),
+            headers=self.headers,
+            data=json.dumps({
+                'ended': not creator.master_revision.entity_data.ended
+            })
+        )
+        self.assert200(response)
+
+        response = self.client.get(
+            '/creator/{}/'.format(entity_gid),
+            query_string={'since_revision': original_revision_id}
+        )
+        self.assert200(response)
+        self.assertEquals(response.json[u'since_revision_id'],
+                          original_revision_id)
+        self.assertFalse(response.json[u'deleted'])
+        self.assertTrue(u'ended' in response.json[u'changes'])
+
+        response = self.client.get(
+            '/creator/{}/'.format(entity_gid),
+            query_string={
+                'since_revision': response.json[u'revision_id']
+            }
+        )
+        self.assertStatus(response, 304)
+
+    def test_history(self):
+        creator = self.get_creator()
+        entity_gid = creator.entity_gid
+        original_revision_id = creator.master_revision_id
+
+        response = self.client.patch(
+            '/creator/{}/'.format(entity_gid),
+            headers=self.headers,
+            data=json.dumps({
+                'ended': not creator.master_revision.entity_data.ended
+            })
+        )
+        self.assert200(response)
+
+        response = self.client.get('/creator/{}/history'.format(entity_gid))
+        self.assert200(response)
+
+        history = json.loads(response.data)
+        self.assertEquals(len(history), 2)
+        self.assertEquals(history[0][u'revision_id'], original_revision_id)
+        self.assertEquals(len(history[1][u'changes']), 1)
+        self.assertTrue(u'ended' in history[1][u'changes'][0])
+
+    def count_history_queries(self, entity_gid):
+        """ Requests the history of an entity with an empty session,
+        returning the number of queries made while streaming it.
+        """
+        def get_history():
+            response = self.client.get(
+                '/creator/{}/history'.format(entity_gid)
+            )
+            # The diffs are made while the response is streamed
+            json.loads(response.data)
+            return response
+
+        response, count = count_queries(get_history)
+        self.assert200(response)
+        return count
+
+    def test_history_query_count(self):
+        entity_gid = self.get_creator().entity_gid
+
+        counts = []
+        for _ in range(3):
+            creator = self.get_creator()
+            response = self.client.patch(
+                '/creator/{}/'.format(entity_gid),
+                headers=self.headers,
+                data=json.dumps({
+                    'ended': not creator.master_revision.entity_data.ended
+                })
+            )
+            self.assert200(response)
+            counts.append(self.count_history_queries(entity_gid))
+
+        self.assertEquals(counts[0], counts[-1])
+
+    def test_history_bad_entity(self):
+        response = self.client.get(
+            '/creator/{}/history'.format(
+                '00000000-0000-0000-0000-000000000000'
+            )
+        )
+        self.assert404(response)
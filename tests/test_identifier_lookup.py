@@ -0,0 +1,79 @@
+# -*- coding: utf8 -*-
+
+# Copyright (C) 2016  Ben Ockmore
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import json
+
+from bbschema import Entity, create_all
+from flask_testing import TestCase
+
+from bbws import create_app, db
+from .fixture import load_data
+
+
+class TestIdentifierLookup(TestCase):
+    def create_app(self):
+        return create_app('../config/test.py')
+
+    # noinspection PyPep8Naming
+    def setUp(self):
+        db.engine.execute("DROP SCHEMA IF EXISTS bookbrainz CASCADE")
+        db.engine.execute("CREATE SCHEMA bookbrainz")
+        create_all(db.engine)
+        load_data(db)
+
+    # noinspection PyPep8Naming
+    def tearDown(self):
+        db.session.remove()
+        db.engine.execute("DROP SCHEMA IF EXISTS bookbrainz CASCADE")
+
+    def make_request(self, identifiers):
+        return self.client.post(
+            '/identifier/lookup',
+            headers=[('Content-Type', 'application/json')],
+            data=json.dumps({'identifiers': identifiers})
+        )
+
+    def test_lookup(self):
+        entities = db.session.query(Entity).all()
+        entity = [x for x in entities
+                  if x.master_revision.entity_data.identifiers][0]
+        identifier = entity.master_revision.entity_data.identifiers[0]
+
+        response = self.make_request([
+            {'identifier_type_id': identifier.identifier_type_id,
+             'value': identifier.value},
+            {'identifier_type_id': identifier.identifier_type_id,
+             'value': u'not-an-identifier-value'}
+        ])
+        self.assert200(response)
+
+        self.assertEquals(response.json[u'count'], 1)
+        result = response.json[u'objects'][0]
+        self.assertEquals(result[u'value'], identifier.value)
+        self.assertTrue(
+            unicode(entity.entity_gid) in
+            [x[u'entity_gid'] for x in result[u'entities']]
+        )
+
+        self.assertEquals(len(response.json[u'unknown']), 1)
+        self.assertEquals(response.json[u'unknown'][0][u'value'],
+                          u'not-an-identifier-value')
+
+    def test_lookup_bad_body(self):
+        response = self.make_request([{'value': u'abc'}])
+        self.assert400(response)
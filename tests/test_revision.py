@@ -0,0 +1,350 @@
+# -*- coding: utf8 -*-
+
+# Copyright (C) 2016  Ben Ockmore
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import json
+
+from bbschema import Creator, Revision, create_all
+from flask_testing import TestCase
+from sqlalchemy import func
+from werkzeug.test import Headers
+
+from bbws import cache, create_app, db
+from bbws.revision import REVISION_CACHE_KEY, RevisionStreamResource
+from bbws.util import encode_cursor
+from .fixture import load_data
+from .query_counting import count_queries
+
+
+class TestRevision(TestCase):
+    """ Tests for the revision endpoints. """
+    def create_app(self):
+        return create_app('../config/test.py')
+
+    # noinspection PyPep8Naming
+    def setUp(self):
+        db.engine.execute("DROP SCHEMA IF EXISTS bookbrainz CASCADE")
+        db.engine.execute("CREATE SCHEMA bookbrainz")
+        create_all(db.engine)
+        load_data(db)
+
+        # Revision IDs are reused after the schema is recreated
+        for key in cache.scan_iter(REVISION_CACHE_KEY.format('*')):
+            cache.delete(key)
+
+        response = self.client.post(
+            '/oauth/token',
+            data={
+                'client_id': '9ab9da7e-a7a3-4f86-87c6-bf8b4b8213c7',
+                'username': 'Bob',
+                'password': "bb",
+                'grant_type': 'password'
+            })
+
+        self.assert200(response)
+        self.headers = Headers(
+            [('Authorization',
+              'Bearer ' + response.json.get(u'access_token')),
+             ('Content-Type', 'application/json')])
+
+    # noinspection PyPep8Naming
+    def tearDown(self):
+        db.session.remove()
+        db.engine.execute("DROP SCHEMA IF EXISTS bookbrainz CASCADE")
+
+    def get_creator(self):
+        return db.session.query(Creator).\
+            order_by(Creator.entity_gid).first()
+
+    def count_queries(self, url):
+        """ Requests url with an empty session, returning the number of
+        queries made while handling the request.
+        """
+        response, count = count_queries(self.client.get, url)
+        self.assert200(response)
+        return count
+
+    def test_get_cached(self):
+        revision_id = self.get_creator().master_revision_id
+
+        first = self.client.get('/revision/{}/'.format(revision_id))
+        self.assert200(first)
+        self.assertEquals(
+            cache.hlen(REVISION_CACHE_KEY.format(revision_id)), 1
+        )
+
+        second = self.client.get('/revision/{}/'.format(revision_id))
+        self.assert200(second)
+        self.assertEquals(first.json, second.json)
+
+    def test_get_cached_expires(self):
+        revision_id = self.get_creator().master_revision_id
+
+        response = self.client.get('/revision/{}/'.format(revision_id))
+        self.assert200(response)
+        self.assertGreater(
+            cache.ttl(REVISION_CACHE_KEY.format(revision_id)), 0
+        )
+
+    def test_get_cached_invalidated(self):
+        creator = self.get_creator()
+        revision_id = creator.master_revision_id
+
+        response = self.client.get('/revision/{}/'.format(revision_id))
+        self.assert200(response)
+        self.assertIsNone(response.json['parent_id'])
+
+        response = self.client.patch(
+            '/creator/{}/'.format(creator.entity_gid),
+            headers=self.headers,
+            data=json.dumps({'ended': not creator.master_revision.
+                             entity_data.ended})
+        )
+        self.assert200(response)
+
+        db.session.expire_all()
+        new_revision_id = self.get_creator().master_revision_id
+
+        response = self.client.get('/revision/{}/'.format(revision_id))
+        self.assert200(response)
+        self.assertEquals(response.json['parent_id'], new_revision_id)
+
+    def test_list_cursor(self):
+        response = self.client.get('/revision/?limit=10')
+        self.assert200(response)
+        expected = [revision['revision_id']
+                    for revision in response.json['objects']]
+
+        response = self.client.get('/revision/?limit=5')
+        self.assert200(response)
+        first_page = response.json['objects']
+        self.assertIsNotNone(response.json['next_cursor'])
+
+        response = self.client.get('/revision/?limit=5&cursor={}'.format(
+            response.json['next_cursor']
+        ))
+        self.assert200(response)
+        second_page = response.json['objects']
+
+        self.assertEquals(
+            [revision['revision_id'] for revision in first_page + second_page],
+            expected
+        )
+
+    def test_list_bad_cursor(self):
+        response = self.client.get('/revision/?cursor=notacursor')
+        self.assert400(response)
+
+        response = self.client.get('/revision/?limit=5')
+        response = self.client.get('/revision/?offset=5&cursor={}'.format(
+            response.json['next_cursor']
+        ))
+        self.assert400(response)
+
+    def test_list_query_count(self):
+        for url in ['/revision/?limit={}',
+                    '/revision/?type=entity&limit={}']:
+            self.assertEquals(self.count_queries(url.format(2)),
+                              self.count_queries(url.format(10)))
+
+    def update_creator(self):
+        creator = self.get_creator()
+        response = self.client.patch(
+            '/creator/{}/'.format(creator.entity_gid),
+            headers=self.headers,
+            data=json.dumps({'ended': not creator.master_revision.
+                             entity_data.ended})
+        )
+        self.assert200(response)
+
+        db.session.expire_all()
+        return self.get_creator().master_revision_id
+
+    def test_ancestors_and_descendants(self):
+        first_id = self.get_creator().master_revision_id
+        second_id = self.update_creator()
+        third_id = self.update_creator()
+
+        response = self.client.get(
+            '/revision/{}/ancestors'.format(first_id)
+        )
+        self.assert200(response)
+        self.assertEquals(
+            [revision['revision_id'] for revision in response.json['objects']],
+            [second_id, third_id]
+        )
+
+        response = self.client.get(
+            '/revision/{}/descendants'.format(third_id)
+        )
+        self.assert200(response)
+        self.assertEquals(
+            [revision['revision_id'] for revision in response.json['objects']],
+            [second_id, first_id]
+        )
+
+        response = self.client.get(
+            '/revision/{}/ancestors?depth=1'.format(first_id)
+        )
+        self.assert200(response)
+        self.assertEquals(
+            [revision['revision_id'] for revision in response.json['objects']],
+            [second_id]
+        )
+
+    def test_ancestors_bad_revision(self):
+        response = self.client.get('/revision/{}/ancestors'.format(1000000))
+        self.assert404(response)
+
+    def test_stream_poll_since(self):
+        latest_id = db.session.query(func.max(Revision.revision_id)).scalar()
+        new_id = self.update_creator()
+
+        response = self.client.get(
+            '/revision/stream',
+            query_string={'poll': 'true', 'since': latest_id, 'timeout': 1}
+        )
+        self.assert200(response)
+        self.assertEquals(
+            [published['revision_id']
+             for published in response.json['objects']],
+            [new_id]
+        )
+
+        response = self.client.get(
+            '/revision/stream',
+            query_string={'poll': 'true', 'since': latest_id,
+                          'type': 'relationship', 'timeout': 0}
+        )
+        self.assertStatus(response, 204)
+
+    def test_stream_poll_gap(self):
+        self.app.config['REVISION_STREAM_BACKLOG'] = 1
+
+        latest_id = db.session.query(func.max(Revision.revision_id)).scalar()
+        self.update_creator()
+        self.update_creator()
+
+        response = self.client.get(
+            '/revision/stream',
+            query_string={'poll': 'true', 'since': latest_id, 'timeout': 1}
+        )
+        self.assert200(response)
+        self.assertEquals(response.json['count'], 0)
+        self.assertEquals(response.json['gap']['since'], latest_id)
+        self.assertIn('/revision/export', response.json['gap']['export_uri'])
+
+    def test_missed_events_query_count(self):
+        self.app.config['REVISION_STREAM_BACKLOG'] = 1000
+        latest_id = db.session.query(func.max(Revision.revision_id)).scalar()
+
+        # The entities of all the missed revisions are loaded together
+        counts = []
+        for since in [latest_id - 1, 0]:
+            (events, complete), count = count_queries(
+                RevisionStreamResource.missed_events, since
+            )
+            self.assertTrue(complete)
+            counts.append(count)
+
+        self.assertGreater(len(events), 1)
+        self.assertEquals(counts[0], counts[1])
+
+    def test_stream_poll_timeout(self):
+        response = self.client.get(
+            '/revision/stream', query_string={'poll': 'true', 'timeout': 0}
+        )
+        self.assertStatus(response, 204)
+
+    def test_export(self):
+        self.app.config['REVISION_EXPORT_LAG'] = 0
+
+        latest_id = db.session.query(func.max(Revision.revision_id)).scalar()
+        new_id = self.update_creator()
+
+        response = self.client.get(
+            '/revision/export', query_string={'after': latest_id}
+        )
+        self.assert200(response)
+
+        lines = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEquals(len(lines), 2)
+        self.assertEquals(lines[0]['revision_id'], new_id)
+        self.assertEquals(lines[0]['entity_type'], 'creator')
+        self.assertFalse(lines[0]['deleted'])
+        self.assertIsNotNone(lines[0]['data'])
+
+        resume_token = lines[1]['resume_token']
+        response = self.client.get(
+            '/revision/export', query_string={'resume': resume_token}
+        )
+        self.assert200(response)
+
+        lines = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEquals(lines, [{'resume_token': resume_token}])
+
+    def count_export_queries(self, after):
+        """ Exports the revisions after a revision ID with an empty session,
+        returning the number of lines and of queries made while streaming
+        them.
+        """
+        def export():
+            response = self.client.get(
+                '/revision/export', query_string={'after': after}
+            )
+            self.assert200(response)
+            return len(response.data.splitlines())
+
+        return count_queries(export)
+
+    def test_export_query_count(self):
+        self.app.config['REVISION_EXPORT_LAG'] = 0
+
+        latest_id = db.session.query(func.max(Revision.revision_id)).scalar()
+        self.update_creator()
+        lines, few = self.count_export_queries(latest_id)
+        self.assertEquals(lines, 2)
+
+        # The data of every revision in a chunk, and its relations, are
+        # loaded together
+        self.update_creator()
+        self.update_creator()
+        lines, many = self.count_export_queries(latest_id)
+        self.assertEquals(lines, 4)
+        self.assertEquals(few, many)
+
+    def test_export_lag(self):
+        latest_id = db.session.query(func.max(Revision.revision_id)).scalar()
+        self.update_creator()
+
+        response = self.client.get(
+            '/revision/export', query_string={'after': latest_id}
+        )
+        self.assert200(response)
+
+        # The new revision is too recent to be exported, and is not skipped
+        # by the resume token
+        lines = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEquals(lines, [{
+            'resume_token': encode_cursor([latest_id])
+        }])
+
+    def test_export_bad_resume(self):
+        response = self.client.get(
+            '/revision/export', query_string={'resume': 'notatoken'}
+        )
+        self.assert400(response)
@@ -0,0 +1,488 @@
+# -*- coding: utf8 -*-
+
+# Copyright (C) 2016  Ben Ockmore
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import json
+import uuid
+
+import mock
+from bbschema import Alias, Creator, Entity, create_all
+from elasticsearch import ConnectionError, TransportError, helpers
+from flask_testing import TestCase
+
+import bbws.search
+from bbws import cache, create_app, db
+from bbws.search import (document_hits, hydrate_hits, index_actions,
+                         reindex)
+from bbws.util import (SEARCH_GENERATION_KEY, bump_search_generation,
+                       decode_cursor, encode_cursor, es_breaker)
+from .fixture import load_data
+from .query_counting import count_queries
+
+
+def make_es_hits(gids, size=None):
+    """ Builds an Elasticsearch search response with a hit for each of
+    gids, all of which are creators.
+    """
+    return {
+        'hits': {
+            'total': len(gids) if size is None else size,
+            'max_score': 1.0,
+            'hits': [{
+                '_id': gid,
+                '_type': 'creator',
+                '_score': 1.0,
+                '_source': {'entity_gid': gid, 'type': 'Creator'},
+                'sort': [1.0, gid]
+            } for gid in gids]
+        }
+    }
+
+
+class TestSearch(TestCase):
+    """ Tests for searching and indexing. Elasticsearch is replaced by a
+    mock, which each test sets up with the responses it needs.
+    """
+    def create_app(self):
+        return create_app('../config/test.py')
+
+    # noinspection PyPep8Naming
+    def setUp(self):
+        db.engine.execute("DROP SCHEMA IF EXISTS bookbrainz CASCADE")
+        db.engine.execute("CREATE SCHEMA bookbrainz")
+        create_all(db.engine)
+        load_data(db)
+
+        # Cached results and patterns would outlive the recreated schema
+        for pattern in ['search:*', SEARCH_GENERATION_KEY.format('*')]:
+            for key in cache.scan_iter(pattern):
+                cache.delete(key)
+        bbws.search.identifier_patterns = None
+
+        es_breaker.failures = 0
+        es_breaker.opened_at = None
+
+        patcher = mock.patch('bbws.search.get_es_connection')
+        self.es = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+
+    # noinspection PyPep8Naming
+    def tearDown(self):
+        db.session.remove()
+        db.engine.execute("DROP SCHEMA IF EXISTS bookbrainz CASCADE")
+
+    def get_creators(self):
+        return db.session.query(Creator).order_by(Creator.entity_gid).all()
+
+    def search(self, **args):
+        response = self.client.get('/search/', query_string=args)
+        self.assert200(response)
+        return response.json
+
+    def multi_search(self, queries):
+        response = self.client.post(
+            '/search/multi',
+            headers=[('Content-Type', 'application/json')],
+            data=json.dumps(queries)
+        )
+        self.assert200(response)
+        return response.json['responses']
+
+    def make_hits(self, entities):
+        return {
+            'total': len(entities),
+            'hits': [{'_id': str(entity.entity_gid), '_score': 1.0}
+                     for entity in entities]
+        }
+
+    def count_hydrate_queries(self, hits, hydrate):
+        """ Hydrates hits with an empty session, returning the number of
+        queries made.
+        """
+        with self.app.test_request_context():
+            return count_queries(hydrate_hits, hits, hydrate)[1]
+
+    def test_hydrate(self):
+        entities = db.session.query(Entity).all()
+        hits = self.make_hits(entities)
+
+        with self.app.test_request_context():
+            hydrate_hits(hits, 'full')
+
+        self.assertEquals(len(hits['hits']), len(entities))
+        for hit in hits['hits']:
+            self.assertIn('revision', hit['_source'])
+            self.assertIn('default_alias', hit['_source'])
+
+    def test_hydrate_query_count(self):
+        entities = db.session.query(Entity).order_by(Entity.entity_gid).all()
+
+        # One entity of each type, so that the same queries are needed
+        one_of_each = {}
+        for entity in entities:
+            one_of_each.setdefault(entity._type, entity)
+
+        few = self.make_hits(one_of_each.values())
+        many = self.make_hits(entities)
+        self.assertEquals(self.count_hydrate_queries(few, 'full'),
+                          self.count_hydrate_queries(many, 'full'))
+
+    def test_document_query_count(self):
+        entities = db.session.query(Entity).order_by(Entity.entity_gid).all()
+
+        one_of_each = {}
+        for entity in entities:
+            one_of_each.setdefault(entity._type, entity)
+
+        # Search documents need the data of each type, including languages
+        # and edition formats, which are loaded in bulk
+        counts = []
+        for chosen in [one_of_each.values(), entities]:
+            with self.app.test_request_context():
+                counts.append(count_queries(
+                    document_hits, self.make_hits(chosen)
+                )[1])
+
+        self.assertEquals(counts[0], counts[1])
+
+    def test_hydrate_stub(self):
+        creator = self.get_creators()[0]
+        hits = self.make_hits([creator])
+
+        with self.app.test_request_context():
+            hydrate_hits(hits, 'stub')
+
+        source = hits['hits'][0]['_source']
+        self.assertEquals(source['entity_gid'], str(creator.entity_gid))
+        self.assertIn('uri', source)
+        self.assertNotIn('revision', source)
+
+    def test_bad_args(self):
+        gid = str(uuid.uuid4())
+        cursor = encode_cursor([1.0, gid])
+        for args in [{'size': 1000}, {'from': 100000}, {'size': -1},
+                     {'facets': 'type,unknown'}, {'hydrate': 'deep'},
+                     {'search_after': 'notacursor'},
+                     {'search_after': encode_cursor([1.0])},
+                     {'search_after': encode_cursor([True, gid])},
+                     {'search_after': cursor, 'from': 10}]:
+            args['q'] = u'foo'
+            response = self.client.get('/search/', query_string=args)
+            self.assert400(response)
+
+        self.assertFalse(self.es.search.called)
+
+    def test_search_after(self):
+        gids = sorted(str(creator.entity_gid)
+                      for creator in self.get_creators()[:2])
+        self.es.search.return_value = make_es_hits(gids, size=10)
+
+        result = self.search(q=u'foo', size=2)
+        self.assertEquals(decode_cursor(result['next_cursor']),
+                          [1.0, gids[-1]])
+
+        self.search(q=u'foo', size=2, search_after=result['next_cursor'])
+        body = self.es.search.call_args[1]['body']
+        self.assertEquals(body['search_after'], [1.0, gids[-1]])
+        self.assertEquals(body['from'], 0)
+
+    def test_last_page(self):
+        gid = str(self.get_creators()[0].entity_gid)
+        self.es.search.return_value = make_es_hits([gid])
+
+        result = self.search(q=u'foo', size=2)
+        self.assertIsNone(result['next_cursor'])
+
+    def test_cache(self):
+        self.es.search.return_value = make_es_hits([])
+
+        self.search(q=u'foo', collection='creator')
+        self.search(q=u'FOO', collection='creator')
+        self.assertEquals(self.es.search.call_count, 1)
+
+        # Indexing other collections doesn't invalidate the results
+        bump_search_generation('work')
+        self.search(q=u'foo', collection='creator')
+        self.assertEquals(self.es.search.call_count, 1)
+
+        bump_search_generation('creator')
+        self.search(q=u'foo', collection='creator')
+        self.assertEquals(self.es.search.call_count, 2)
+
+    def test_cache_all(self):
+        self.es.search.return_value = make_es_hits([])
+
+        # Type facets search every collection, so any change invalidates them
+        self.search(q=u'foo', collection='creator', facets='type')
+        bump_search_generation('work')
+        self.search(q=u'foo', collection='creator', facets='type')
+        self.assertEquals(self.es.search.call_count, 2)
+
+    def test_facets(self):
+        self.es.search.return_value = make_es_hits([])
+        self.es.search.return_value['aggregations'] = {
+            'type': {'buckets': [{'key': 'Work', 'doc_count': 5},
+                                 {'key': 'Creator', 'doc_count': 2}]},
+            'language': {'buckets': [{'key': 'English', 'doc_count': 4}]}
+        }
+
+        result = self.search(q=u'foo', collection='creator',
+                             facets='type,language')
+        self.assertEquals(result['facets'], {
+            'type': [{'value': 'work', 'count': 5},
+                     {'value': 'creator', 'count': 2}],
+            'language': [{'value': 'English', 'count': 4}]
+        })
+
+        kwargs = self.es.search.call_args[1]
+        self.assertEquals(kwargs['index'], 'bookbrainz')
+        self.assertEquals(sorted(kwargs['body']['aggs']),
+                          ['language', 'type'])
+        self.assertEquals(kwargs['body']['post_filter'],
+                          {'term': {'type': 'Creator'}})
+
+    def test_hydrated_search(self):
+        creators = self.get_creators()[:2]
+        gids = [str(creator.entity_gid) for creator in creators]
+        self.es.search.return_value = make_es_hits(
+            gids + [str(uuid.uuid4())]
+        )
+
+        # Hits for entities missing from the database are dropped
+        result = self.search(q=u'foo', hydrate='full')
+        self.assertEquals([hit['_id'] for hit in result['hits']], gids)
+        self.assertIn('revision', result['hits'][0]['_source'])
+        self.assertFalse(self.es.search.call_args[1]['body']['_source'])
+
+    def test_hydrated_search_cache(self):
+        gid = str(self.get_creators()[0].entity_gid)
+        self.es.search.return_value = make_es_hits([gid])
+        for hit in self.es.search.return_value['hits']['hits']:
+            del hit['_source']
+
+        first = self.search(q=u'foo', hydrate='stub')
+        self.assertIn('entity_gid', first['hits'][0]['_source'])
+
+        # Only the IDs are cached, and are hydrated again for every search
+        keys = list(cache.scan_iter('search:*'))
+        self.assertEquals(len(keys), 1)
+        cached = json.loads(cache.get(keys[0]))
+        self.assertNotIn('_source', cached['hits'][0])
+
+        second = self.search(q=u'foo', hydrate='stub')
+        self.assertEquals(self.es.search.call_count, 1)
+        self.assertEquals(second['hits'], first['hits'])
+
+    def test_multi_search(self):
+        gid = str(self.get_creators()[0].entity_gid)
+        self.es.msearch.return_value = {'responses': [
+            make_es_hits([gid]),
+            {'error': {'type': 'parsing_exception'}}
+        ]}
+
+        first = self.multi_search([{'q': u'foo'}, {'q': u'bar'}])
+        self.assertEquals([hit['_id'] for hit in first[0]['hits']], [gid])
+        self.assertEquals(first[1],
+                          {'error': {'type': 'parsing_exception'}})
+
+        # Cached and uncached results are returned in the requested order
+        self.es.msearch.return_value = {'responses': [
+            {'error': {'type': 'parsing_exception'}}
+        ]}
+        second = self.multi_search([{'q': u'bar'}, {'q': u'foo'}])
+        self.assertEquals(second[0],
+                          {'error': {'type': 'parsing_exception'}})
+        self.assertEquals(second[1], first[0])
+
+        body = self.es.msearch.call_args[1]['body']
+        self.assertEquals(len(body), 2)
+        self.assertEquals(body[1]['query']['multi_match']['query'], u'bar')
+
+    def test_route_uuid(self):
+        gid = str(self.get_creators()[0].entity_gid)
+
+        result = self.search(q=gid)
+        self.assertEquals([hit['_id'] for hit in result['hits']], [gid])
+        self.assertEquals(result['hits'][0]['_source']['entity_gid'], gid)
+        self.assertFalse(self.es.search.called)
+
+        responses = self.multi_search([{'q': gid}])
+        self.assertEquals(responses[0]['hits'], result['hits'])
+        self.assertFalse(self.es.msearch.called)
+
+    def set_identifier(self, value, regex):
+        """ Sets the value of an identifier of an entity, and the detection
+        regex of its type. Returns the entity's GID.
+        """
+        entity = [entity for entity in db.session.query(Entity).all()
+                  if entity.master_revision.entity_data.identifiers][0]
+        identifier = entity.master_revision.entity_data.identifiers[0]
+        identifier.value = value
+        identifier.identifier_type.detection_regex = regex
+        db.session.commit()
+
+        return str(entity.entity_gid)
+
+    def test_route_identifier(self):
+        gid = self.set_identifier(u'isbn-0000000001', u'^isbn-\\d+$')
+
+        result = self.search(q=u'isbn-0000000001', hydrate='stub')
+        self.assertEquals([hit['_id'] for hit in result['hits']], [gid])
+        self.assertIn('uri', result['hits'][0]['_source'])
+        self.assertFalse(self.es.search.called)
+
+    def test_route_identifier_not_found(self):
+        self.set_identifier(u'isbn-0000000001', u'^isbn-\\d+$')
+        self.es.search.return_value = make_es_hits([])
+
+        # Queries that look like identifiers may still be free text
+        self.search(q=u'isbn-0000000002')
+        self.assertTrue(self.es.search.called)
+
+    def test_unavailable(self):
+        self.app.config['SEARCH_FALLBACK'] = None
+        self.es.search.side_effect = ConnectionError('N/A', 'down', None)
+
+        response = self.client.get('/search/', query_string={'q': u'foo'})
+        self.assertStatus(response, 503)
+
+    def test_bad_request(self):
+        self.es.search.side_effect = TransportError(400, 'parsing_exception')
+
+        response = self.client.get('/search/', query_string={'q': u'foo'})
+        self.assert400(response)
+
+    def test_fallback(self):
+        db.engine.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+        creator = self.get_creators()[0]
+        alias = Alias(name=u'Zebediah Quux', sort_name=u'Quux, Zebediah',
+                      primary=True)
+        creator.master_revision.entity_data.aliases.append(alias)
+        db.session.commit()
+        gid = str(creator.entity_gid)
+
+        self.es.search.side_effect = ConnectionError('N/A', 'down', None)
+
+        result = self.search(q=u'zebed', mode='auto')
+        self.assertTrue(result['degraded'])
+        self.assertEquals([hit['_id'] for hit in result['hits']], [gid])
+        self.assertEquals(result['hits'][0]['_source']['entity_gid'], gid)
+
+        # Degraded results are not cached
+        self.es.search.side_effect = None
+        self.es.search.return_value = make_es_hits([gid])
+        result = self.search(q=u'zebed', mode='auto')
+        self.assertNotIn('degraded', result)
+
+    def setup_reindex(self):
+        self.es.indices.exists_template.return_value = False
+        self.es.indices.exists_alias.side_effect = \
+            lambda name: name == 'bookbrainz'
+        self.es.indices.exists.side_effect = \
+            lambda index: index == 'bookbrainz_creator'
+        self.es.indices.get_alias.return_value = {
+            'bookbrainz_v1': {'aliases': {'bookbrainz': {}}}
+        }
+
+        patcher = mock.patch('bbws.search.helpers.bulk')
+        self.bulk = patcher.start()
+        self.bulk.return_value = (0, [])
+        self.addCleanup(patcher.stop)
+
+    def test_reindex_legacy_index(self):
+        self.setup_reindex()
+        self.es.indices.exists_alias.side_effect = lambda name: False
+        self.es.indices.exists.side_effect = \
+            lambda index: index == 'bookbrainz'
+
+        with self.app.test_request_context():
+            reindex()
+
+        # The concrete index is only deleted by the alias update
+        actions = self.es.indices.update_aliases.call_args[1]['body'][
+            'actions']
+        self.assertIn({'remove_index': {'index': 'bookbrainz'}}, actions)
+        self.assertFalse(self.es.indices.delete.called)
+
+    def test_reindex(self):
+        self.setup_reindex()
+
+        with self.app.test_request_context():
+            index_names = reindex()
+
+        self.assertEquals(len(index_names), len(set(index_names)))
+        actions = self.es.indices.update_aliases.call_args[1]['body'][
+            'actions']
+
+        # The old alias and the concrete per-type index are replaced in the
+        # same atomic update that adds the new aliases
+        self.assertIn({'remove': {'index': 'bookbrainz_v1',
+                                  'alias': 'bookbrainz'}}, actions)
+        self.assertIn({'remove_index': {'index': 'bookbrainz_creator'}},
+                      actions)
+        for index_name in index_names:
+            self.assertIn({'add': {'index': index_name,
+                                   'alias': 'bookbrainz'}}, actions)
+        self.assertIn({'add': {'index': index_names[0],
+                               'alias': 'bookbrainz_creator'}}, actions)
+
+        deleted = [call[1]['index']
+                   for call in self.es.indices.delete.call_args_list]
+        self.assertEquals(deleted, ['bookbrainz_v1'])
+
+    def test_reindex_failure(self):
+        self.setup_reindex()
+        self.es.indices.update_aliases.side_effect = \
+            TransportError(400, 'illegal_argument_exception')
+
+        with self.app.test_request_context():
+            self.assertRaises(TransportError, reindex)
+
+        # The new indices are deleted, and the old ones are kept
+        deleted = [call[1]['index']
+                   for call in self.es.indices.delete.call_args_list]
+        self.assertEquals(len(deleted), 1)
+        self.assertNotIn('bookbrainz_v1', deleted[0].split(','))
+        self.assertEquals(len(deleted[0].split(',')), 5)
+
+    def test_index_actions_delete(self):
+        creator = self.get_creators()[0]
+        creator.master_revision.entity_data = None
+        db.session.commit()
+
+        with self.app.test_request_context():
+            self.assertEquals(list(index_actions([creator])), [])
+            self.assertEquals(
+                list(index_actions([creator], delete_missing=True)),
+                [{'_op_type': 'delete', '_index': 'bookbrainz_creator',
+                  '_type': 'creator', '_id': str(creator.entity_gid)}]
+            )
+
+    def test_reindex_catch_up_errors(self):
+        self.setup_reindex()
+
+        # Entities deleted before they were indexed are already missing
+        self.bulk.return_value = (0, [{'delete': {'status': 404}}])
+        with self.app.test_request_context():
+            reindex()
+
+        self.assertFalse(self.bulk.call_args[1]['raise_on_error'])
+
+        self.bulk.return_value = (0, [{'index': {'status': 400}}])
+        with self.app.test_request_context():
+            self.assertRaises(helpers.BulkIndexError, reindex)
@@ -0,0 +1,216 @@
+# -*- coding: utf8 -*-
+
+# Copyright (C) 2016  Ben Ockmore
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import time
+
+import mock
+from elasticsearch import ConnectionError, TransportError
+from flask import request
+from flask_testing import TestCase
+from sqlalchemy.exc import OperationalError
+
+from bbws import cache, create_app
+from bbws.util import (SEARCH_GENERATION_KEY, CircuitBreaker,
+                       CircuitOpenError, es_breaker, index_entity,
+                       retry_transaction)
+
+
+class SerializationFailure(Exception):
+    """ Stands in for the psycopg2 error wrapped by OperationalError. """
+    pgcode = '40001'
+
+
+class UniqueViolation(Exception):
+    pgcode = '23505'
+
+
+def make_failing(errors, calls):
+    """ Returns a handler which raises the first errors in turn, recording
+    each call in calls.
+    """
+    errors = list(errors)
+
+    @retry_transaction
+    def handler():
+        calls.append(request.endpoint)
+        if errors:
+            raise OperationalError('UPDATE', {}, errors.pop(0)())
+        return 'done'
+
+    return handler
+
+
+class TestRetryTransaction(TestCase):
+    """ Tests for the retry_transaction decorator, and the metrics it
+    records.
+    """
+    def create_app(self):
+        app = create_app('../config/test.py')
+        app.config['TRANSACTION_RETRY_DELAY'] = 0
+        return app
+
+    def get_metrics(self):
+        response = self.client.get('/metrics')
+        self.assert200(response)
+        return response.json
+
+    def test_retry(self):
+        before = self.get_metrics()
+
+        calls = []
+        with self.app.test_request_context('/creator/', method='POST'):
+            endpoint = request.endpoint
+            result = make_failing([SerializationFailure], calls)()
+
+        self.assertEquals(result, 'done')
+        self.assertEquals(len(calls), 2)
+
+        after = self.get_metrics()
+        self.assertEquals(after.get('transaction_retries', 0),
+                          before.get('transaction_retries', 0) + 1)
+        key = 'transaction_retries:{}'.format(endpoint)
+        self.assertEquals(after.get(key, 0), before.get(key, 0) + 1)
+
+    def test_retry_failure(self):
+        before = self.get_metrics()
+        retries = self.app.config.get('TRANSACTION_RETRIES', 3)
+
+        calls = []
+        with self.app.test_request_context('/creator/', method='POST'):
+            handler = make_failing([SerializationFailure] * (retries + 1),
+                                   calls)
+            self.assertRaises(OperationalError, handler)
+
+        self.assertEquals(len(calls), retries + 1)
+
+        after = self.get_metrics()
+        self.assertEquals(after.get('transaction_retry_failures', 0),
+                          before.get('transaction_retry_failures', 0) + 1)
+
+    def test_no_retry(self):
+        calls = []
+        with self.app.test_request_context('/creator/', method='POST'):
+            handler = make_failing([UniqueViolation], calls)
+            self.assertRaises(OperationalError, handler)
+
+        self.assertEquals(len(calls), 1)
+
+
+def fail(exc):
+    def call():
+        raise exc
+    return call
+
+
+class TestCircuitBreaker(TestCase):
+    """ Tests for the circuit breaker which guards calls to Elasticsearch. """
+    def create_app(self):
+        app = create_app('../config/test.py')
+        app.config['ELASTICSEARCH_BREAKER_THRESHOLD'] = 2
+        app.config['ELASTICSEARCH_BREAKER_RESET'] = 30
+        return app
+
+    # noinspection PyPep8Naming
+    def setUp(self):
+        self.breaker = CircuitBreaker('test')
+        self.down = fail(ConnectionError('N/A', 'down', None))
+
+    def open_breaker(self):
+        for _ in range(2):
+            self.assertRaises(ConnectionError, self.breaker.call, self.down)
+
+    def test_open(self):
+        self.assertRaises(ConnectionError, self.breaker.call, self.down)
+        self.assertFalse(self.breaker.is_open)
+
+        self.assertRaises(ConnectionError, self.breaker.call, self.down)
+        self.assertTrue(self.breaker.is_open)
+
+        # Calls are rejected without being made while the breaker is open
+        calls = []
+        self.assertRaises(CircuitOpenError, self.breaker.call,
+                          lambda: calls.append(1))
+        self.assertEquals(calls, [])
+
+    def test_half_open(self):
+        self.open_breaker()
+
+        # After the reset time, one trial call is let through
+        self.breaker.opened_at = time.time() - 31
+        self.assertEquals(self.breaker.call(lambda: 'up'), 'up')
+        self.assertFalse(self.breaker.is_open)
+        self.assertEquals(self.breaker.failures, 0)
+
+    def test_half_open_failure(self):
+        self.open_breaker()
+
+        self.breaker.opened_at = time.time() - 31
+        self.assertRaises(ConnectionError, self.breaker.call, self.down)
+        self.assertTrue(self.breaker.is_open)
+        self.assertRaises(CircuitOpenError, self.breaker.call,
+                          lambda: 'up')
+
+    def test_client_errors(self):
+        # Rejected requests mean that Elasticsearch is available
+        bad_request = fail(TransportError(400, 'parsing_exception'))
+        for _ in range(3):
+            self.assertRaises(TransportError, self.breaker.call, bad_request)
+
+        self.assertFalse(self.breaker.is_open)
+
+        server_error = fail(TransportError(503, 'unavailable'))
+        for _ in range(2):
+            self.assertRaises(TransportError, self.breaker.call,
+                              server_error)
+
+        self.assertTrue(self.breaker.is_open)
+
+
+class TestIndexEntity(TestCase):
+    """ Tests for indexing entities, and the invalidation of cached search
+    results that goes with it.
+    """
+    def create_app(self):
+        return create_app('../config/test.py')
+
+    # noinspection PyPep8Naming
+    def setUp(self):
+        es_breaker.failures = 0
+        es_breaker.opened_at = None
+
+    def get_generation(self):
+        return int(cache.get(SEARCH_GENERATION_KEY.format('creator')) or 0)
+
+    def test_wait_for_refresh(self):
+        es_conn = mock.MagicMock()
+        generations = []
+
+        # Records the generation while the document is being indexed
+        es_conn.index.side_effect = \
+            lambda **kwargs: generations.append(self.get_generation())
+
+        before = self.get_generation()
+        index_entity(es_conn, {
+            'entity_gid': '00000000-0000-0000-0000-000000000000',
+            'type': 'Creator'
+        })
+
+        # The results are only invalidated after the document is searchable
+        self.assertEquals(es_conn.index.call_args[1]['refresh'], 'wait_for')
+        self.assertEquals(generations, [before])
+        self.assertEquals(self.get_generation(), before + 1)